@@ -0,0 +1,147 @@
+"""Microbenchmark of the tiIndicator encoder.
+
+Compares IndicatorEncoder with the per-indicator encoding the Output node
+used before, on a mix of indicator types:
+
+    python benchmarks/encoder_bench.py [num_indicators] [repeat]
+
+The two encoders are timed in turn repeat times with the garbage collector
+off, as timeit does, and the best run of each is kept: single runs vary too
+much to compare them.
+"""
+import gc
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+import netaddr
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from microsoft_graph_secapi.encoder import IndicatorEncoder, HASH_2_ISG, SHARE_LEVEL_2_ISG  # noqa
+
+
+def legacy_encode(indicator, value, threat_type='malware', recommended_action='block',
+                  target_product='Azure Sentinel'):
+    type_ = value['type']
+
+    description = '{} indicator from {}'.format(
+        type_,
+        ', '.join(value['sources'])
+    )
+    external_id = '{}:{}'.format(type_, indicator)
+    expiration = datetime.utcnow() + timedelta(days=29)
+    expiration = expiration.isoformat()
+
+    if type_ == 'IPv4' and '-' in indicator:
+        a1, a2 = indicator.split('-', 1)
+        indicators = [str(i) for i in netaddr.IPRange(a1, a2).cidrs()]
+    else:
+        indicators = [indicator]
+
+    result = []
+    for i in indicators:
+        r = {
+            'description': description,
+            'confidence': value['confidence'],
+            'externalId': external_id,
+            'indicator': indicator,
+            'expirationDateTime': expiration,
+            'tlpLevel': SHARE_LEVEL_2_ISG.get(value.get('share_level', 'unknown'), 0),
+            'threatType': threat_type
+        }
+        r['action'] = recommended_action
+        r['targetProduct'] = target_product
+
+        if type_ == 'URL':
+            r['url'] = i
+        elif type_ == 'domain':
+            r['domainName'] = i
+        elif type_ in ['md5', 'sha256', 'sha1']:
+            r['fileHashType'] = HASH_2_ISG[type_]
+            r['fileHashValue'] = i
+        elif type_ == 'IPv4':
+            parsed = netaddr.IPNetwork(i)
+            if parsed.size == 1 and '/' not in i:
+                r['networkIPv4'] = i
+            else:
+                r['networkCidrBlock'] = i
+
+        result.append(r)
+
+    return result
+
+
+def workload(n):
+    sources = [['feed-a'], ['feed-a', 'feed-b'], ['feed-c']]
+    result = []
+    for x in range(n):
+        kind = x % 5
+        value = {
+            'sources': sources[x % len(sources)],
+            'confidence': 50 + x % 50,
+            'share_level': 'green'
+        }
+        if kind == 0:
+            value['type'] = 'IPv4'
+            indicator = '10.{}.{}.{}'.format((x >> 16) & 255, (x >> 8) & 255, x & 255)
+        elif kind == 1:
+            value['type'] = 'IPv4'
+            indicator = '172.16.{}.0/24'.format(x & 255)
+        elif kind == 2:
+            value['type'] = 'domain'
+            indicator = 'host{}.example.com'.format(x)
+        elif kind == 3:
+            value['type'] = 'URL'
+            indicator = 'http://host{}.example.com/path'.format(x)
+        else:
+            value['type'] = 'sha256'
+            indicator = '{:064x}'.format(x)
+        result.append((indicator, value))
+    return result
+
+
+def run(encode, items):
+    gc.disable()
+    try:
+        t0 = time.time()
+        for indicator, value in items:
+            encode(indicator, value)
+        return time.time() - t0
+    finally:
+        gc.enable()
+
+
+def report(name, elapsed, n):
+    print('{:<10} {:>8.3f}s {:>12.0f} indicators/s'.format(name, elapsed, n / elapsed))
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    items = workload(n)
+
+    encoder = IndicatorEncoder(
+        threat_type='malware',
+        recommended_action='block',
+        target_product='Azure Sentinel',
+        tags=['minemeld:bench'],
+        ttl=29*86400,
+        ttl_jitter=24*3600
+    )
+
+    legacy = current = None
+    for _ in range(repeat):
+        t = run(legacy_encode, items)
+        legacy = t if legacy is None else min(legacy, t)
+        t = run(encoder.encode, items)
+        current = t if current is None else min(current, t)
+
+    report('legacy', legacy, len(items))
+    report('encoder', current, len(items))
+    print('speedup    {:>8.2f}x'.format(legacy / current))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,266 @@
+"""Local stand-in for the Graph Security API endpoints used by the Output node.
+
+Serves the token endpoint, submitTiIndicators, deleteTiIndicatorsByExternalId,
+the tiIndicators listing and JSON $batch, answering with the shapes the node
+validates.
+Latency, throttling, per-indicator failures and server errors are configurable:
+
+    python benchmarks/mock_graph.py --port 8080 --latency 0.2 --throttle-rate 0.05
+
+Used in-process by throughput_bench.py through MockGraph.
+"""
+import gevent.monkey
+gevent.monkey.patch_all()
+
+import argparse
+import random
+import time
+import uuid
+import zlib
+from urlparse import parse_qs
+
+import gevent
+import ujson as json
+from gevent.pywsgi import WSGIServer
+
+SUBMIT_CONTEXT = 'https://graph.microsoft.com/beta/$metadata#Collection(tiIndicator)'
+DELETE_CONTEXT = 'https://graph.microsoft.com/beta/$metadata#Collection(microsoft.graph.ResultInfo)'
+LIST_CONTEXT = 'https://graph.microsoft.com/beta/$metadata#security/tiIndicators'
+FAILED_ID = 'Failed to create, check Error element for reason'
+
+SUBMIT_PATH = '/beta/security/tiIndicators/submitTiIndicators'
+DELETE_PATH = '/beta/security/tiIndicators/deleteTiIndicatorsByExternalId'
+LIST_PATH = '/beta/security/tiIndicators'
+BATCH_PATH = '/beta/$batch'
+
+
+class MockGraph(object):
+    """WSGI application emulating Graph.
+
+    latency is the mean answer time in seconds, with latency_jitter
+    seconds of uniform jitter. throttle_rate and error_rate are the
+    fractions of requests answered with 429 (with Retry-After) and 500,
+    failure_rate the fraction of indicators failing inside a successful
+    submit or delete. JSON $batch sub-requests are throttled and failed
+    one by one like separate requests. on_receive, if set, is called with the list of
+    externalIds of every successful request.
+    """
+    def __init__(self, latency=0.0, latency_jitter=0.0, throttle_rate=0.0, retry_after=1,
+                 failure_rate=0.0, error_rate=0.0, token_lifetime=3599, on_receive=None):
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.failure_rate = failure_rate
+        self.error_rate = error_rate
+        self.token_lifetime = token_lifetime
+        self.on_receive = on_receive
+
+        self.indicators = {}
+        self.counters = dict(
+            requests=0, batches=0, throttled=0, errors=0, submitted=0, deleted=0, failed=0, tokens=0
+        )
+
+        self._server = None
+
+    def start(self, host='127.0.0.1', port=0):
+        self._server = WSGIServer((host, port), self, log=None)
+        self._server.start()
+        return 'http://{}:{}'.format(host, self._server.server_port)
+
+    def stop(self):
+        if self._server is not None:
+            self._server.stop()
+            self._server = None
+
+    def __call__(self, environ, start_response):
+        path = environ['PATH_INFO']
+        method = environ['REQUEST_METHOD']
+
+        body = environ['wsgi.input'].read()
+        if environ.get('HTTP_CONTENT_ENCODING', None) == 'gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+
+        if path.endswith('/oauth2/token'):
+            self.counters['tokens'] += 1
+            return self._answer(start_response, '200 OK', {
+                'token_type': 'Bearer',
+                'expires_in': str(self.token_lifetime),
+                'access_token': uuid.uuid4().hex
+            })
+
+        self._sleep()
+
+        if method == 'POST' and path == BATCH_PATH:
+            self.counters['batches'] += 1
+            return self._answer(start_response, '200 OK', self._batch(json.loads(body)['requests']))
+
+        status, result, headers = self._handle(method, path, body, environ)
+        return self._answer(start_response, status, result, headers=headers)
+
+    def _handle(self, method, path, body, environ=None):
+        """Returns (status, body, headers) of a request or sub-request"""
+        self.counters['requests'] += 1
+
+        if random.random() < self.throttle_rate:
+            self.counters['throttled'] += 1
+            return '429 Too Many Requests', {'error': {'code': 'TooManyRequests'}}, \
+                [('Retry-After', str(self.retry_after))]
+
+        if random.random() < self.error_rate:
+            self.counters['errors'] += 1
+            return '500 Internal Server Error', {'error': {'code': 'InternalServerError'}}, None
+
+        if isinstance(body, basestring) and body != '':
+            body = json.loads(body)
+
+        if method == 'POST' and path == SUBMIT_PATH:
+            return '200 OK', self._submit(body['value']), None
+
+        if method == 'POST' and path == DELETE_PATH:
+            return '200 OK', self._delete(body['value']), None
+
+        if method == 'GET' and path == LIST_PATH:
+            return '200 OK', self._list(environ), None
+
+        return '404 Not Found', {'error': {'code': 'NotFound'}}, None
+
+    def _batch(self, requests):
+        # sub-requests run in order, those depending on a failed one get a 424
+        statuses = {}
+        responses = []
+        for r in requests:
+            if any(statuses.get(d, 500) >= 300 for d in r.get('dependsOn', [])):
+                status, result, headers = '424 Failed Dependency', {'error': {'code': 'FailedDependency'}}, None
+            else:
+                status, result, headers = self._handle(r['method'], '/beta' + r['url'], r.get('body', None))
+
+            statuses[r['id']] = int(status.split(' ', 1)[0])
+            responses.append({
+                'id': r['id'],
+                'status': statuses[r['id']],
+                'headers': dict(headers or []),
+                'body': result
+            })
+
+        return {'responses': responses}
+
+    def _sleep(self):
+        delay = self.latency + random.uniform(-self.latency_jitter, self.latency_jitter)
+        if delay > 0:
+            gevent.sleep(delay)
+
+    def _submit(self, records):
+        value = []
+        received = []
+        for r in records:
+            external_id = r['externalId']
+
+            if random.random() < self.failure_rate:
+                self.counters['failed'] += 1
+                value.append({
+                    '@odata.type': '#microsoft.graph.tiIndicator',
+                    'id': FAILED_ID,
+                    'externalId': external_id,
+                    'Error': 'Mock failure'
+                })
+                continue
+
+            graph_id = self.indicators.get(external_id, None)
+            if graph_id is None:
+                graph_id = uuid.uuid4().hex
+                self.indicators[external_id] = graph_id
+
+            self.counters['submitted'] += 1
+            received.append(external_id)
+            value.append({
+                '@odata.type': '#microsoft.graph.tiIndicator',
+                'id': graph_id,
+                'externalId': external_id
+            })
+
+        if self.on_receive is not None:
+            self.on_receive(received)
+
+        return {'@odata.context': SUBMIT_CONTEXT, 'value': value}
+
+    def _delete(self, external_ids):
+        value = []
+        received = []
+        for external_id in external_ids:
+            if random.random() < self.failure_rate:
+                self.counters['failed'] += 1
+                value.append({'code': '500', 'message': '{} mock failure'.format(external_id)})
+                continue
+
+            if self.indicators.pop(external_id, None) is None:
+                value.append({'code': '404', 'message': '{} not found'.format(external_id)})
+            else:
+                value.append({'code': '204', 'message': '{} deleted'.format(external_id)})
+
+            self.counters['deleted'] += 1
+            received.append(external_id)
+
+        if self.on_receive is not None:
+            self.on_receive(received)
+
+        return {'@odata.context': DELETE_CONTEXT, 'value': value}
+
+    def _list(self, environ):
+        query = parse_qs(environ.get('QUERY_STRING', ''))
+        top = int(query.get('$top', ['100'])[0])
+        skip = int(query.get('$skiptoken', ['0'])[0])
+
+        external_ids = sorted(self.indicators.keys())[skip:skip + top]
+        result = {
+            '@odata.context': LIST_CONTEXT,
+            'value': [{'id': self.indicators[e], 'externalId': e} for e in external_ids]
+        }
+        if skip + top < len(self.indicators):
+            result['@odata.nextLink'] = 'http://{}{}?$top={}&$skiptoken={}'.format(
+                environ['HTTP_HOST'], LIST_PATH, top, skip + top
+            )
+
+        return result
+
+    def _answer(self, start_response, status, body, headers=None):
+        body = json.dumps(body)
+        start_response(status, [
+            ('Content-Type', 'application/json'),
+            ('Content-Length', str(len(body)))
+        ] + (headers or []))
+        return [body]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Mock Graph Security API server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--latency-jitter', type=float, default=0.0)
+    parser.add_argument('--throttle-rate', type=float, default=0.0)
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--failure-rate', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    args = parser.parse_args()
+
+    graph = MockGraph(
+        latency=args.latency,
+        latency_jitter=args.latency_jitter,
+        throttle_rate=args.throttle_rate,
+        retry_after=args.retry_after,
+        failure_rate=args.failure_rate,
+        error_rate=args.error_rate
+    )
+    print('Mock Graph listening on {}'.format(graph.start(args.host, args.port)))
+
+    try:
+        while True:
+            gevent.sleep(10)
+            print('{:.0f} {}'.format(time.time(), graph.counters))
+    except KeyboardInterrupt:
+        graph.stop()
+
+
+if __name__ == '__main__':
+    main()
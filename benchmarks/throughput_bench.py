@@ -0,0 +1,228 @@
+"""Throughput benchmark of the Output node against the mock Graph server.
+
+Drives Output.filtered_update/filtered_withdraw at a fixed rate for a given
+duration, then waits for the queue to drain and reports indicators/sec,
+end-to-end latency percentiles (enqueue to received by the mock), queue depth
+over time and the CPU time spent encoding. Needs a MineMeld environment:
+
+    python benchmarks/throughput_bench.py --rate 500 --duration 60 --latency 0.2
+
+The node and the mock share the gevent loop, so their CPU time adds up.
+"""
+import gevent.monkey
+gevent.monkey.patch_all()
+
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import gevent
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from mock_graph import MockGraph, SUBMIT_PATH, DELETE_PATH, LIST_PATH, BATCH_PATH  # noqa
+from microsoft_graph_secapi import node  # noqa
+
+TYPES = ['URL', 'domain', 'IPv4', 'sha256']
+
+
+class MockAuthenticationContext(object):
+    """Replaces adal.AuthenticationContext, asks the token to the mock.
+    adal only accepts https authorities.
+    """
+    url = None
+
+    def __init__(self, authority, **kwargs):
+        self.authority = authority
+
+    def acquire_token_with_client_credentials(self, resource, client_id, client_secret):
+        tenant_id = self.authority.rsplit('/', 1)[-1]
+        result = requests.post(
+            '{}/{}/oauth2/token'.format(self.url, tenant_id),
+            data={'grant_type': 'client_credentials', 'resource': resource,
+                  'client_id': client_id, 'client_secret': client_secret}
+        ).json()
+        return {'accessToken': result['access_token'], 'expiresIn': int(result['expires_in'])}
+
+
+def make_indicator(n):
+    type_ = TYPES[n % len(TYPES)]
+    if type_ == 'URL':
+        indicator = 'www.example{}.com/path/{}'.format(n, n)
+    elif type_ == 'domain':
+        indicator = 'example{}.net'.format(n)
+    elif type_ == 'IPv4':
+        indicator = '10.{}.{}.{}'.format((n >> 16) & 0xff, (n >> 8) & 0xff, n & 0xff)
+    else:
+        indicator = '{:064x}'.format(n)
+
+    return type_, indicator, {
+        'type': type_,
+        'sources': ['feed{}'.format(n % 3)],
+        'confidence': 50 + n % 50,
+        'share_level': 'green'
+    }
+
+
+def percentile(values, p):
+    if len(values) == 0:
+        return float('nan')
+    return values[min(int(len(values) * p / 100.0), len(values) - 1)]
+
+
+def run(args):
+    sent_at = {}
+    latencies = []
+
+    def on_receive(external_ids):
+        now = time.time()
+        for external_id in external_ids:
+            t = sent_at.pop(external_id, None)
+            if t is not None:
+                latencies.append(now - t)
+
+    graph = MockGraph(
+        latency=args.latency,
+        latency_jitter=args.latency / 2,
+        throttle_rate=args.throttle_rate,
+        failure_rate=args.failure_rate,
+        error_rate=args.error_rate,
+        on_receive=on_receive
+    )
+    url = graph.start()
+
+    MockAuthenticationContext.url = url
+    node.adal.AuthenticationContext = MockAuthenticationContext
+    node.ENDPOINT_URL = url + LIST_PATH
+    node.ENDPOINT_SUBMITBATCH = url + SUBMIT_PATH
+    node.ENDPOINT_DELETEBATCH = url + DELETE_PATH
+    node.ENDPOINT_JSONBATCH = url + BATCH_PATH
+
+    workdir = tempfile.mkdtemp(prefix='isgbench')
+    os.environ['MM_CONFIG_DIR'] = workdir
+    cwd = os.getcwd()
+    os.chdir(workdir)
+
+    try:
+        output = node.Output('bench', None, {
+            'client_id': 'bench',
+            'client_secret': 'bench',
+            'tenant_id': 'bench',
+            'rate_limit': args.rate_limit,
+            'rate_burst': args.rate_limit * 2,
+            'max_inflight_batches': args.inflight,
+            'http_compression': args.compression,
+            'http_batching': args.batching,
+            'encoder_processes': args.encoder_processes,
+            'queue_maxsize': args.queue_maxsize,
+            'reconcile_interval': 0
+        })
+        output.initialize()
+        output.start()
+
+        # CPU time spent encoding, the node is single threaded
+        encode_cpu = [0.0]
+        encode = output._encode_indicator
+
+        def timed_encode(*a, **kw):
+            c0 = time.clock()
+            try:
+                return encode(*a, **kw)
+            finally:
+                encode_cpu[0] += time.clock() - c0
+        output._encode_indicator = timed_encode
+
+        depth = []
+
+        def sample_depth():
+            t0 = time.time()
+            while True:
+                depth.append((time.time() - t0, output.length()))
+                gevent.sleep(1.0)
+        sampler = gevent.spawn(sample_depth)
+
+        announced = []
+        total = int(args.rate * args.duration)
+        t0 = time.time()
+        cpu0 = time.clock()
+
+        for n in range(total):
+            # pace the feed, yielding to the node between indicators
+            delay = t0 + float(n) / args.rate - time.time()
+            gevent.sleep(max(delay, 0))
+
+            if len(announced) != 0 and random.random() < args.withdraw_ratio:
+                type_, indicator, value = announced.pop(random.randrange(len(announced)))
+                sent_at['{}:{}'.format(type_, indicator)] = time.time()
+                output.filtered_withdraw(source='bench', indicator=indicator, value=value)
+                continue
+
+            type_, indicator, value = make_indicator(n)
+            announced.append((type_, indicator, value))
+            sent_at['{}:{}'.format(type_, indicator)] = time.time()
+            output.filtered_update(source='bench', indicator=indicator, value=value)
+
+        feed_time = time.time() - t0
+
+        deadline = time.time() + args.drain_timeout
+        while output.length() != 0 and time.time() < deadline:
+            gevent.sleep(0.1)
+        while any(len(d.inflight) != 0 for d in output._destinations.values()) and time.time() < deadline:
+            gevent.sleep(0.1)
+
+        elapsed = time.time() - t0
+        cpu = time.clock() - cpu0
+        sampler.kill()
+        output.stop()
+
+    finally:
+        graph.stop()
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    latencies.sort()
+    handled = graph.counters['submitted'] + graph.counters['deleted']
+
+    print('indicators fed:       {} in {:.1f}s ({:.0f}/s)'.format(total, feed_time, total / feed_time))
+    print('indicators handled:   {} in {:.1f}s ({:.0f}/s)'.format(handled, elapsed, handled / elapsed))
+    print('latency p50/p90/p99:  {:.3f}s / {:.3f}s / {:.3f}s (max {:.3f}s)'.format(
+        percentile(latencies, 50), percentile(latencies, 90), percentile(latencies, 99),
+        latencies[-1] if latencies else float('nan')
+    ))
+    print('not delivered:        {} (cancelled in the queue or dead-lettered)'.format(len(sent_at)))
+    print('CPU total / encoding: {:.2f}s / {:.2f}s ({:.1f} us per indicator)'.format(
+        cpu, encode_cpu[0], encode_cpu[0] * 1e6 / max(total, 1)
+    ))
+    print('mock counters:        {}'.format(graph.counters))
+    print('queue depth:          {}'.format(' '.join(
+        '{:.0f}s:{}'.format(t, d) for t, d in depth[::max(len(depth) // 20, 1)]
+    )))
+    print('node statistics:      {}'.format(dict(output.statistics)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Output node throughput benchmark')
+    parser.add_argument('--rate', type=float, default=200, help='indicators per second fed to the node')
+    parser.add_argument('--duration', type=float, default=30, help='seconds of feed')
+    parser.add_argument('--withdraw-ratio', type=float, default=0.1)
+    parser.add_argument('--drain-timeout', type=float, default=120)
+    parser.add_argument('--rate-limit', type=float, default=100, help='node rate_limit')
+    parser.add_argument('--inflight', type=int, default=4, help='node max_inflight_batches')
+    parser.add_argument('--compression', action='store_true', help='node http_compression')
+    parser.add_argument('--batching', action='store_true', help='node http_batching')
+    parser.add_argument('--encoder-processes', type=int, default=0, help='node encoder_processes')
+    parser.add_argument('--queue-maxsize', type=int, default=100000, help='node queue_maxsize')
+    parser.add_argument('--latency', type=float, default=0.1, help='mock answer time')
+    parser.add_argument('--throttle-rate', type=float, default=0.0)
+    parser.add_argument('--failure-rate', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    run(parser.parse_args())
+
+
+if __name__ == '__main__':
+    main()
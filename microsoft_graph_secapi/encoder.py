@@ -0,0 +1,202 @@
+import hashlib
+import time
+import zlib
+from datetime import datetime
+
+import netaddr
+import ujson as json
+
+HASH_2_ISG = {
+    'sha1': 1,
+    'sha256': 2,
+    'md5': 3
+}
+
+SHARE_LEVEL_2_ISG = {
+    'white': 1,
+    'green': 2,
+    'amber': 3,
+    'red': 4
+}
+
+SUPPORTED_TYPES = frozenset(['URL', 'domain', 'md5', 'sha256', 'sha1', 'IPv4'])
+
+EXPIRED = datetime.fromtimestamp(0).isoformat()
+
+# Maximum number of interned descriptions
+MAX_DESCRIPTIONS = 4096
+# Number of distinct expiration offsets used to spread the jitter
+EXPIRATION_BUCKETS = 64
+
+
+class EncodedRecord(dict):
+    """tiIndicator record that keeps its JSON serialization.
+
+    The fragment is computed the first time it is needed, usually when
+    the record is written to the queue log, and then reused for every
+    request body the record is part of. Records must not be modified
+    once serialized.
+    """
+    __slots__ = ['_fragment']
+
+    def __init__(self, *args, **kwargs):
+        super(EncodedRecord, self).__init__(*args, **kwargs)
+        self._fragment = None
+
+    @property
+    def fragment(self):
+        if self._fragment is None:
+            self._fragment = json.dumps(self, escape_forward_slashes=False)
+        return self._fragment
+
+    @classmethod
+    def from_fragment(cls, fragment):
+        """Returns the record serialized in fragment, keeping fragment as
+        its serialization.
+        """
+        result = cls(json.loads(fragment))
+        result._fragment = fragment
+        return result
+
+    def extend(self, fields, fields_fragment):
+        """Returns a copy of the record with fields added. fields_fragment
+        is the serialization of fields, appended to the cached fragment of
+        the record instead of serializing the copy again. fields must not
+        be already in the record.
+        """
+        if len(fields) == 0:
+            return self
+
+        result = EncodedRecord(self)
+        result.update(fields)
+        result._fragment = self.fragment[:-1] + ',' + fields_fragment[1:]
+        return result
+
+
+def fragment(record):
+    """Returns the JSON serialization of a record, cached if the record
+    is an EncodedRecord.
+    """
+    if isinstance(record, EncodedRecord):
+        return record.fragment
+    return json.dumps(record, escape_forward_slashes=False)
+
+
+def content_hash(records, exclude):
+    """Returns the hash of the content of records, fields in exclude
+    left out.
+    """
+    content = [
+        dict((k, v) for k, v in r.iteritems() if k not in exclude)
+        for r in records
+    ]
+    return hashlib.sha1(json.dumps(content, sort_keys=True)).hexdigest()
+
+
+class IndicatorEncoder(object):
+    """Encodes MineMeld indicators into Graph tiIndicator records.
+
+    Fields that are constant for the node (threatType, action,
+    targetProduct, tags) are precomputed in a template at construction, so the
+    encoder is rebuilt when the node config or side config changes.
+    Descriptions are interned per type and source set, and expiration
+    timestamps are formatted once per second for each of the
+    EXPIRATION_BUCKETS jitter offsets. An indicator always falls in the
+    same bucket, so ttl_jitter spreads expirations deterministically.
+    """
+    def __init__(self, threat_type, recommended_action=None, target_product=None,
+                 tags=None, ttl=29*86400, ttl_jitter=0):
+        self.ttl = ttl
+        self.ttl_jitter = ttl_jitter
+
+        self._template = {
+            'threatType': threat_type
+        }
+        if recommended_action is not None:
+            self._template['action'] = recommended_action
+        if target_product is not None:
+            self._template['targetProduct'] = target_product
+        if tags:
+            self._template['tags'] = list(tags)
+
+        self._descriptions = {}
+        self._expiration_second = None
+        self._expirations = {}
+
+    def expiration(self, external_id):
+        now = int(time.time())
+        if now != self._expiration_second:
+            self._expiration_second = now
+            self._expirations = {}
+
+        if isinstance(external_id, unicode):
+            external_id = external_id.encode('utf8')
+        bucket = (zlib.crc32(external_id) & 0xffffffff) % EXPIRATION_BUCKETS
+
+        result = self._expirations.get(bucket, None)
+        if result is None:
+            offset = int(self.ttl_jitter * bucket / (EXPIRATION_BUCKETS - 1))
+            result = datetime.utcfromtimestamp(now + self.ttl - offset).isoformat()
+            self._expirations[bucket] = result
+
+        return result
+
+    def description(self, type_, sources):
+        key = (type_, tuple(sources))
+
+        result = self._descriptions.get(key, None)
+        if result is None:
+            if len(self._descriptions) >= MAX_DESCRIPTIONS:
+                self._descriptions = {}
+            result = '{} indicator from {}'.format(type_, ', '.join(sources))
+            self._descriptions[key] = result
+
+        return result
+
+    def encode(self, indicator, value, expired=False, external_id=None):
+        """Returns the list of tiIndicator records for indicator, or None
+        if its type is not supported.
+        """
+        type_ = value['type']
+        if type_ not in SUPPORTED_TYPES:
+            return None
+
+        if external_id is None:
+            external_id = '{}:{}'.format(type_, indicator)
+
+        record = EncodedRecord(self._template)
+        record['description'] = self.description(type_, value['sources'])
+        record['confidence'] = value['confidence']
+        record['externalId'] = external_id
+        record['indicator'] = indicator
+        record['expirationDateTime'] = EXPIRED if expired else self.expiration(external_id)
+        record['tlpLevel'] = SHARE_LEVEL_2_ISG.get(value.get('share_level', 'unknown'), 0)
+
+        if type_ == 'URL':
+            record['url'] = indicator
+            return [record]
+
+        if type_ == 'domain':
+            record['domainName'] = indicator
+            return [record]
+
+        if type_ == 'IPv4':
+            if '-' in indicator:
+                a1, a2 = indicator.split('-', 1)
+                result = []
+                for cidr in netaddr.IPRange(a1, a2).cidrs():
+                    r = EncodedRecord(record)
+                    r['networkCidrBlock'] = str(cidr)
+                    result.append(r)
+                return result
+
+            # single addresses have no prefix length, anything else is a block
+            if '/' in indicator:
+                record['networkCidrBlock'] = indicator
+            else:
+                record['networkIPv4'] = indicator
+            return [record]
+
+        record['fileHashType'] = HASH_2_ISG[type_]
+        record['fileHashValue'] = indicator
+        return [record]
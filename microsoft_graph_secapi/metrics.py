@@ -0,0 +1,45 @@
+import bisect
+
+# Bucket upper bounds (seconds) of the timing histograms
+TIME_BOUNDS = [0.0001, 0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+# Bucket upper bounds of the batch size histogram
+SIZE_BOUNDS = [1, 2, 5, 10, 20, 50, 100]
+
+
+def _duration_label(seconds):
+    if seconds < 0.001:
+        return '{:g}us'.format(seconds * 1000000)
+    if seconds < 1:
+        return '{:g}ms'.format(seconds * 1000)
+    return '{:g}s'.format(seconds)
+
+
+class Histogram(object):
+    """Fixed buckets histogram kept as flat counters in the node statistics.
+
+    Each observation increments <name>.le_<bound> of the first bucket
+    whose bound is not smaller than the value (le_inf past the last one),
+    <name>.count, and <name>.sum. With timing=True values are seconds,
+    bounds are labelled as durations (le_250ms) and the sum is kept in
+    microseconds as <name>.sum_us.
+    """
+    def __init__(self, statistics, name, bounds, timing=True):
+        self.statistics = statistics
+        self.bounds = bounds
+
+        label = _duration_label if timing else str
+        self._keys = ['{}.le_{}'.format(name, label(b)) for b in bounds]
+        self._keys.append('{}.le_inf'.format(name))
+
+        self._count_key = '{}.count'.format(name)
+        if timing:
+            self._sum_key = '{}.sum_us'.format(name)
+            self._sum_scale = 1000000
+        else:
+            self._sum_key = '{}.sum'.format(name)
+            self._sum_scale = 1
+
+    def observe(self, value):
+        self.statistics[self._keys[bisect.bisect_left(self.bounds, value)]] += 1
+        self.statistics[self._count_key] += 1
+        self.statistics[self._sum_key] += int(value * self._sum_scale)
@@ -1,26 +1,42 @@
+import calendar
+import itertools
 import logging
 import os
+import re
 import shutil
 import time
-import uuid
-import netaddr
-from datetime import datetime, timedelta
-from collections import deque
+import zlib
+from datetime import datetime
+from collections import deque, OrderedDict
 
 import adal  #pylint: disable=E0401
 import gevent
+import gevent.event
+import gevent.lock
+import gevent.pool
 import requests
 import yaml
 import ujson as json
-from gevent.queue import Queue, Empty, Full
-from netaddr import IPNetwork
+from gevent.queue import Full
+from requests.adapters import HTTPAdapter
 from requests.exceptions import RequestException, HTTPError
 
 from minemeld.ft import ft_states  #pylint: disable=E0401
+from minemeld.ft import table  #pylint: disable=E0401
 from minemeld.ft.base import _counting  #pylint: disable=E0401
 from minemeld.ft.actorbase import ActorBaseFT  #pylint: disable=E0401
 from minemeld import __version__
 
+from .pending import PendingQueue, REPLACED, CANCELLED, SPILLED, EVICTED, OVERFLOW_SPILL, OVERFLOW_POLICIES
+from .spill import SegmentLog
+from .ratelimit import RateController, parse_retry_after
+from .encoder import IndicatorEncoder, EncodedRecord, fragment, content_hash, EXPIRED
+from .ranges import RangeExpander
+from .reconcile import ExternalIdSet
+from .metrics import Histogram, TIME_BOUNDS, SIZE_BOUNDS
+from .workers import EncoderPool
+from .tracing import Tracer, TRACE_BUFFER_SIZE
+
 LOG = logging.getLogger(__name__)
 AUTHORITY_BASE_URL = 'https://login.microsoftonline.com'
 AUTHORITY_URL = 'https://login.microsoftonline.com/{}'
@@ -29,24 +45,95 @@ ENDPOINT_VERSION='beta'
 ENDPOINT_URL = 'https://graph.microsoft.com/{}/security/tiIndicators'.format(ENDPOINT_VERSION)
 ENDPOINT_SUBMITBATCH=ENDPOINT_URL+'/submitTiIndicators'
 ENDPOINT_DELETEBATCH=ENDPOINT_URL+'/deleteTiIndicatorsByExternalId'
+# JSON batching, sub-request URLs are relative to the API version
+ENDPOINT_JSONBATCH='https://graph.microsoft.com/{}/$batch'.format(ENDPOINT_VERSION)
+JSONBATCH_SUBMIT_URL='/security/tiIndicators/submitTiIndicators'
+JSONBATCH_DELETE_URL='/security/tiIndicators/deleteTiIndicatorsByExternalId'
 USER_AGENT= 'PaloAltoNetworks-MineMeld/{}'.format(__version__)
 # Maximum number of batch upload
 MAX_BATCH_SIZE=50
-
-HASH_2_ISG = {
-    'sha1': 1,
-    'sha256': 2,
-    'md5': 3
-}
-
-SHARE_LEVEL_2_ISG = {
-    'white': 1,
-    'green': 2,
-    'amber': 3,
-    'red': 4
-}
-
-EXPIRED = datetime.fromtimestamp(0).isoformat()
+# Default pacing of requests to Graph: requests per second and burst
+RATE_LIMIT=4
+RATE_BURST=8
+# Default number of retries of a failed request and maximum backoff (seconds)
+MAX_RETRIES=5
+BACKOFF_MAX=120
+# Default number of attempts for a single indicator before it is dead-lettered
+MAX_ITEM_ATTEMPTS=5
+# Kinds of failed indicators: rejected by Graph and retried with their own
+# attempt budget, rejected for good, or failed with the whole request
+# (outage, throttling, timeouts) and queued again without using an attempt
+FAILED_ITEM='item'
+FAILED_PERMANENT='permanent'
+FAILED_TRANSIENT='transient'
+# Batches answered slower than this (seconds) shrink the batch size
+TARGET_LATENCY=10
+# Refresh cached tokens this many seconds before they expire
+TOKEN_REFRESH_MARGIN=300
+# Lifetime assumed when the token response does not carry expiresIn
+TOKEN_DEFAULT_LIFETIME=3599
+# Default HTTP connection pool size and timeouts (seconds) for Graph calls
+HTTP_POOL_SIZE=10
+HTTP_CONNECT_TIMEOUT=10
+HTTP_READ_TIMEOUT=60
+# Request bodies smaller than this (bytes) are never compressed
+HTTP_COMPRESSION_MIN_SIZE=1024
+# Default number of batches concurrently sent to Graph
+MAX_INFLIGHT_BATCHES=4
+# Default lifetime (days) of submitted indicators and maximum reduction (hours)
+# applied to it per indicator, so indicators pushed together don't expire together
+INDICATOR_TTL=29
+INDICATOR_TTL_JITTER=24
+# Indicators are re-submitted this many hours before they expire, at most
+# REFRESH_RATE indicators per second, checking every REFRESH_INTERVAL seconds
+REFRESH_LEAD=48
+REFRESH_RATE=10
+REFRESH_INTERVAL=60
+# Hours between two reconciliations with what Graph holds, 0 to disable
+# the scheduled runs, and number of tiIndicators per page while listing
+RECONCILE_INTERVAL=0
+RECONCILE_PAGE_SIZE=1000
+# Prefix of the tag marking the indicators pushed by a node, only those
+# can be deleted as orphans by the reconciliation
+NODE_TAG_PREFIX='minemeld:'
+# Default number of seconds a checkpoint waits for the queue to drain,
+# what is left is sent after the next start
+CHECKPOINT_TIMEOUT=30
+# Priority lanes of the pending queue, highest priority first, and their
+# default weights in the batch scheduler
+LANE_WITHDRAW='withdraw'
+LANE_NEW='new'
+LANE_UPDATE='update'
+LANE_REFRESH='refresh'
+LANE_WEIGHTS=[(LANE_WITHDRAW, 8), (LANE_NEW, 4), (LANE_UPDATE, 2), (LANE_REFRESH, 1)]
+# Lanes that skip the operations waiting in the queue log
+EXPRESS_LANES=[LANE_WITHDRAW, LANE_NEW]
+# Share of queue_maxsize the withdraw lane can use over it
+EXPRESS_RESERVE=0.1
+# Default low watermark of the queue, as a share of the high watermark
+QUEUE_LOW_WATERMARK=0.8
+# Destination used when the config lists none, it keeps the queue log and
+# state tables of the node
+DEFAULT_DESTINATION='default'
+# Destination attributes that can be set per destination, the node
+# attributes with the same name are the defaults
+DESTINATION_ATTRIBUTES=['tenant_id', 'client_id', 'client_secret', 'target_product',
+                        'recommended_action', 'rate_limit', 'rate_burst']
+DESTINATION_NAME_RE=re.compile('^[A-Za-z0-9_-]+$')
+# tiIndicator fields set per destination, left out of the content hash and
+# fingerprinted separately in the state table with the tenant and client
+DESTINATION_FIELDS=frozenset(['targetProduct', 'action'])
+HASH_EXCLUDED_FIELDS=DESTINATION_FIELDS | frozenset(['expirationDateTime'])
+
+# Indicators per request to an encoder worker
+ENCODER_BATCH_SIZE=1000
+# Indicators per second under which encoding stays in the node process
+ENCODER_THRESHOLD=500
+# externalId of the CIDRs generated from IPv4 ranges, kept apart from the
+# externalIds of the CIDRs announced as such
+RANGE_EXTERNAL_ID='IPv4range:{}'
+# Attributes of a range value stored to re-encode its CIDRs
+RANGE_VALUE_ATTRIBUTES=['type', 'sources', 'confidence', 'share_level']
 
 
 class AuthConfigException(RuntimeError):
@@ -55,22 +142,223 @@ class AuthConfigException(RuntimeError):
 class SecurityGraphResponseException(RuntimeError):
     pass
 
+class TokenCache(object):
+    """Caches ADAL access tokens per (tenant_id, client_id).
+
+    Cached tokens are refreshed in the background TOKEN_REFRESH_MARGIN
+    seconds before they expire, so the push loop normally never waits
+    on login.microsoftonline.com.
+    """
+    def __init__(self, name, statistics, refresh_margin=TOKEN_REFRESH_MARGIN):
+        self.name = name
+        self.statistics = statistics
+        self.refresh_margin = refresh_margin
+
+        self._entries = {}
+        self._refresh_glets = {}
+        self._lock = gevent.lock.Semaphore()
+
+    def get(self, tenant_id, client_id, client_secret):
+        key = (tenant_id, client_id)
+
+        entry = self._entries.get(key, None)
+        if entry is not None and entry['secret'] == client_secret and entry['expires_at'] > time.time():
+            self.statistics['token.cache_hit'] += 1
+            return entry['token']
+
+        with self._lock:
+            # another greenlet could have refreshed the token while we waited
+            entry = self._entries.get(key, None)
+            if entry is not None and entry['secret'] == client_secret and entry['expires_at'] > time.time():
+                self.statistics['token.cache_hit'] += 1
+                return entry['token']
+
+            self.statistics['token.cache_miss'] += 1
+            return self._acquire(tenant_id, client_id, client_secret)
+
+    def invalidate(self):
+        for glet in self._refresh_glets.values():
+            glet.kill()
+        self._refresh_glets = {}
+        self._entries = {}
+
+    def _acquire(self, tenant_id, client_id, client_secret):
+        key = (tenant_id, client_id)
+
+        t0 = time.time()
+        context = adal.AuthenticationContext(
+            AUTHORITY_URL.format(tenant_id),
+            validate_authority=tenant_id != 'adfs',
+            api_version=None
+        )
+
+        token = context.acquire_token_with_client_credentials(
+            RESOURCE,
+            client_id,
+            client_secret
+        )
+
+        if token is None or 'accessToken' not in token:
+            LOG.error('{} - Invalid token or accessToken not available'.format(self.name))
+            raise RuntimeError('{} - Invalid token or accessToken not available'.format(self.name))
+
+        self.statistics['token.refresh'] += 1
+
+        # expiresIn is relative to the request, expiresOn is a naive local time string
+        lifetime = int(token.get('expiresIn', TOKEN_DEFAULT_LIFETIME))
+        self._entries[key] = {
+            'token': token['accessToken'],
+            'secret': client_secret,
+            'expires_at': t0 + lifetime
+        }
+
+        old_glet = self._refresh_glets.pop(key, None)
+        if old_glet is not None and old_glet is not gevent.getcurrent():
+            old_glet.kill()
+        self._refresh_glets[key] = gevent.spawn_later(
+            max(lifetime - self.refresh_margin, 1),
+            self._background_refresh,
+            tenant_id, client_id, client_secret
+        )
+
+        return token['accessToken']
+
+    def _background_refresh(self, tenant_id, client_id, client_secret):
+        try:
+            with self._lock:
+                self._acquire(tenant_id, client_id, client_secret)
+            self.statistics['token.background_refresh'] += 1
+
+        except gevent.GreenletExit:
+            raise
+
+        except Exception as e:
+            # the cached token stays valid until expiration, next get() retries
+            LOG.error('{} - error refreshing token in background: {}'.format(self.name, str(e)))
+            self.statistics['error.token_refresh'] += 1
+
+class Destination(object):
+    """A tenant and target product the Output node pushes indicators to.
+
+    Holds everything that is not shared between destinations: credentials
+    and tiIndicator fields, queue, token cache, rate controller, HTTP
+    session, push loop and state tables. path is the prefix of the queue
+    log and state tables on disk.
+    """
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+
+        self.tenant_id = None
+        self.client_id = None
+        self.client_secret = None
+        self.target_product = None
+        self.recommended_action = None
+
+        self.fields = {}
+        self.fields_fragment = '{}'
+        self.fingerprint = None
+
+        self.pending = None
+        self.inflight = {}
+        self.inflight_records = 0
+        self.rate = None
+        self.token_cache = None
+        self.session = None
+        self.session_token = None
+
+        self.push_pool = None
+        self.push_glet = None
+
+        self.table = None
+        self.table_trusted = False
+        self.deadletter = None
+
+    def configure(self, config):
+        self.tenant_id = config.get('tenant_id', None)
+        self.client_id = config.get('client_id', None)
+        self.client_secret = config.get('client_secret', None)
+        self.target_product = config.get('target_product', None)
+        self.recommended_action = config.get('recommended_action', None)
+
+        self.fields = {}
+        if self.recommended_action is not None:
+            self.fields['action'] = self.recommended_action
+        if self.target_product is not None:
+            self.fields['targetProduct'] = self.target_product
+        self.fields_fragment = json.dumps(self.fields, escape_forward_slashes=False)
+        # what an indicator pushed with another tenant, client or fields
+        # has to be sent again for
+        self.fingerprint = content_hash([dict(self.fields, tenant_id=self.tenant_id, client_id=self.client_id)], ())
+
+    def records(self, records):
+        """Returns the records of this destination for the shared records"""
+        return [r.extend(self.fields, self.fields_fragment) for r in records]
+
+
 class Output(ActorBaseFT):
     def __init__(self, name, chassis, config):
-        self._queue = None
-
         super(Output, self).__init__(name, chassis, config)
 
-        self._push_glet = None
+        self._refresh_glet = None
+        self._reconcile_loop_glet = None
+        self._reconcile_glet = None
         self._checkpoint_glet = None
 
+        self._destinations = OrderedDict()
+        self._backpressure = False
+        self._started = False
+        self._tables_open = False
+        self._tables_trusted = False
+        self._batch_done = gevent.event.Event()
+        self._ranges = RangeExpander()
+        self._ranges_table = None
+
+        self._encoder_pool = None
+        self._encode_glet = None
+        self._encode_buffer = deque()
+        self._encode_wakeup = gevent.event.Event()
+        self._arrivals_second = None
+        self._arrivals = 0
+
+        self._encode_timing = Histogram(self.statistics, 'timing.encode', TIME_BOUNDS)
+        self._token_timing = Histogram(self.statistics, 'timing.token', TIME_BOUNDS)
+        self._request_timings = {
+            'delete': Histogram(self.statistics, 'timing.delete', TIME_BOUNDS),
+            'create/update': Histogram(self.statistics, 'timing.submit', TIME_BOUNDS),
+            'batch': Histogram(self.statistics, 'timing.batch', TIME_BOUNDS)
+        }
+        self._rate_wait_timing = Histogram(self.statistics, 'timing.rate_wait', TIME_BOUNDS)
+        self._backoff_timing = Histogram(self.statistics, 'timing.backoff', TIME_BOUNDS)
+        self._batch_sizes = Histogram(self.statistics, 'batch.size', SIZE_BOUNDS, timing=False)
+        self._encode_pool_timing = Histogram(self.statistics, 'timing.encode_pool', TIME_BOUNDS)
+        self._lane_latencies = dict(
+            (lane, Histogram(self.statistics, 'lane.{}.latency'.format(lane), TIME_BOUNDS))
+            for lane, _ in LANE_WEIGHTS
+        )
+
+        self._configure_destinations()
+
     def configure(self):
         super(Output, self).configure()
 
         self.queue_maxsize = int(self.config.get('queue_maxsize', 100000))
         if self.queue_maxsize == 0:
             self.queue_maxsize = None
-        self._queue = Queue(maxsize=self.queue_maxsize)
+        self.spill_maxsize = int(self.config.get('spill_maxsize', 10000000))
+        if self.spill_maxsize == 0:
+            self.spill_maxsize = None
+
+        self.queue_overflow = self.config.get('queue_overflow', OVERFLOW_SPILL)
+        if self.queue_overflow not in OVERFLOW_POLICIES:
+            LOG.error('{} - invalid queue_overflow {!r}, using {}'.format(self.name, self.queue_overflow, OVERFLOW_SPILL))
+            self.queue_overflow = OVERFLOW_SPILL
+
+        self.queue_high_watermark = int(self.config.get('queue_high_watermark', self.queue_maxsize or 0))
+        self.queue_low_watermark = int(self.config.get(
+            'queue_low_watermark',
+            self.queue_high_watermark * QUEUE_LOW_WATERMARK
+        ))
 
         self.client_id = self.config.get('client_id', None)
         self.client_secret = self.config.get('client_secret', None)
@@ -81,6 +369,45 @@ class Output(ActorBaseFT):
 
         self.target_product = self.config.get('target_product', 'minemeld')
         self.threat_type = self.config.get('threat_type', 'malware')
+        self.destinations = self.config.get('destinations', None)
+
+        lane_weights = self.config.get('lane_weights', None) or {}
+        self.lane_weights = [
+            (lane, max(float(lane_weights.get(lane, weight)), 0.01)) for lane, weight in LANE_WEIGHTS
+        ]
+        self.priority_rules = self._parse_priority_rules(self.config.get('priority_rules', None) or [])
+
+        self.max_inflight_batches = int(self.config.get('max_inflight_batches', MAX_INFLIGHT_BATCHES))
+
+        self.encoder_processes = int(self.config.get('encoder_processes', 0))
+        self.encoder_batch_size = int(self.config.get('encoder_batch_size', ENCODER_BATCH_SIZE))
+        self.encoder_threshold = int(self.config.get('encoder_threshold', ENCODER_THRESHOLD))
+
+        self.indicator_ttl = float(self.config.get('indicator_ttl', INDICATOR_TTL)) * 86400
+        self.indicator_ttl_jitter = float(self.config.get('indicator_ttl_jitter', INDICATOR_TTL_JITTER)) * 3600
+        self.refresh_lead = float(self.config.get('refresh_lead', REFRESH_LEAD)) * 3600
+        self.refresh_rate = float(self.config.get('refresh_rate', REFRESH_RATE))
+        self.refresh_interval = float(self.config.get('refresh_interval', REFRESH_INTERVAL))
+        self.reconcile_interval = float(self.config.get('reconcile_interval', RECONCILE_INTERVAL)) * 3600
+        self.reconcile_page_size = int(self.config.get('reconcile_page_size', RECONCILE_PAGE_SIZE))
+        self.node_tag = NODE_TAG_PREFIX + self.name
+        self.checkpoint_timeout = float(self.config.get('checkpoint_timeout', CHECKPOINT_TIMEOUT))
+
+        self.max_retries = int(self.config.get('max_retries', MAX_RETRIES))
+        self.max_item_attempts = int(self.config.get('max_item_attempts', MAX_ITEM_ATTEMPTS))
+        self.rate_limit = float(self.config.get('rate_limit', RATE_LIMIT))
+        self.rate_burst = float(self.config.get('rate_burst', RATE_BURST))
+        self.max_batch_size = int(self.config.get('max_batch_size', MAX_BATCH_SIZE))
+        self.target_latency = float(self.config.get('target_latency', TARGET_LATENCY))
+        self.backoff_max = float(self.config.get('backoff_max', BACKOFF_MAX))
+
+        self.http_pool_size = int(self.config.get('http_pool_size', HTTP_POOL_SIZE))
+        self.http_timeout = (
+            float(self.config.get('http_connect_timeout', HTTP_CONNECT_TIMEOUT)),
+            float(self.config.get('http_read_timeout', HTTP_READ_TIMEOUT))
+        )
+        self.http_compression = bool(self.config.get('http_compression', False))
+        self.http_batching = bool(self.config.get('http_batching', False))
 
         self.side_config_path = self.config.get('side_config', None)
         if self.side_config_path is None:
@@ -89,7 +416,46 @@ class Output(ActorBaseFT):
                 '%s_side_config.yml' % self.name
             )
 
+        self.trace_sample_rate = float(self.config.get('trace_sample_rate', 0.0))
+        self.trace_buffer_size = int(self.config.get('trace_buffer_size', TRACE_BUFFER_SIZE))
+
         self._load_side_config()
+        self._configure_encoder()
+
+        self._tracer = Tracer(sample_rate=self.trace_sample_rate, size=self.trace_buffer_size)
+
+    def _parse_priority_rules(self, rules):
+        result = []
+        lanes = set(lane for lane, _ in LANE_WEIGHTS)
+
+        for rule in rules:
+            if not isinstance(rule, dict) or rule.get('lane', None) not in lanes:
+                LOG.error('{} - invalid priority rule {!r}, rule ignored'.format(self.name, rule))
+                continue
+
+            result.append({
+                'lane': rule['lane'],
+                'min_confidence': rule.get('min_confidence', None),
+                'sources': frozenset(rule['sources']) if rule.get('sources', None) else None,
+                'types': frozenset(rule['types']) if rule.get('types', None) else None
+            })
+
+        return result
+
+    def _priority_lane(self, value):
+        """Returns the lane of the first priority rule matching value,
+        None if no rule matches.
+        """
+        for rule in self.priority_rules:
+            if rule['min_confidence'] is not None and value.get('confidence', 0) < rule['min_confidence']:
+                continue
+            if rule['types'] is not None and value.get('type', None) not in rule['types']:
+                continue
+            if rule['sources'] is not None and rule['sources'].isdisjoint(value.get('sources', [])):
+                continue
+            return rule['lane']
+
+        return None
 
     def _load_side_config(self):
         try:
@@ -125,348 +491,1238 @@ class Output(ActorBaseFT):
             self.target_product = target_product
             LOG.info('{} - target_product set'.format(self.name))
 
+        destinations = sconfig.get('destinations', None)
+        if destinations is not None:
+            self.destinations = destinations
+            LOG.info('{} - destinations set'.format(self.name))
+
+        trace_sample_rate = sconfig.get('trace_sample_rate', None)
+        if trace_sample_rate is not None:
+            self.trace_sample_rate = float(trace_sample_rate)
+            LOG.info('{} - trace_sample_rate set'.format(self.name))
+
+    def _destination_configs(self):
+        """Returns the config of each destination by name. Attributes not
+        set on a destination are taken from the node.
+        """
+        defaults = dict((a, getattr(self, a)) for a in DESTINATION_ATTRIBUTES)
+
+        if not self.destinations:
+            return OrderedDict([(DEFAULT_DESTINATION, defaults)])
+
+        result = OrderedDict()
+        for d in self.destinations:
+            name = d.get('name', None) if isinstance(d, dict) else None
+            if name is None or not DESTINATION_NAME_RE.match(str(name)):
+                LOG.error('{} - invalid destination name {!r}, destination ignored'.format(self.name, name))
+                continue
+
+            config = dict(defaults)
+            config.update((k, v) for k, v in d.iteritems() if k in DESTINATION_ATTRIBUTES and v is not None)
+            result[str(name)] = config
+
+        return result
+
+    def _configure_destinations(self):
+        configs = self._destination_configs()
+
+        for name in list(self._destinations.keys()):
+            if name not in configs:
+                LOG.info('{} - destination {} removed'.format(self.name, name))
+                dest = self._destinations.pop(name)
+                self._stop_destination(dest)
+                self._close_destination(dest)
+
+        for name, config in configs.iteritems():
+            dest = self._destinations.get(name, None)
+            if dest is None:
+                dest = self._new_destination(name, config)
+                self._destinations[name] = dest
+
+                if self._tables_open:
+                    self._open_destination(dest)
+                if self._started:
+                    self._start_destination(dest)
+                continue
+
+            dest.configure(config)
+            dest.rate.rate = float(config['rate_limit'])
+            dest.rate.burst = float(config['rate_burst'])
+            dest.token_cache.invalidate()
+
+    def _new_destination(self, name, config):
+        path = self.name
+        if name != DEFAULT_DESTINATION:
+            path = os.path.join('{}_destinations'.format(self.name), name)
+
+        dest = Destination(name, path)
+        dest.pending = PendingQueue(
+            maxsize=self.queue_maxsize,
+            is_published=lambda key: self._is_published(dest, key),
+            log=SegmentLog('{}_queue'.format(path)),
+            log_maxsize=self.spill_maxsize,
+            lanes=self.lane_weights,
+            express=EXPRESS_LANES,
+            reserve=int((self.queue_maxsize or 0) * EXPRESS_RESERVE),
+            overflow=self.queue_overflow,
+            evict=LANE_REFRESH
+        )
+        dest.token_cache = TokenCache('{}:{}'.format(self.name, name), self.statistics)
+        dest.configure(config)
+
+        dest.rate = RateController(
+            rate=float(config['rate_limit']),
+            burst=float(config['rate_burst']),
+            max_batch_size=self.max_batch_size,
+            target_latency=self.target_latency,
+            backoff_max=self.backoff_max
+        )
+
+        return dest
+
+    def _open_destination(self, dest, truncate=False):
+        self._close_destination(dest)
+
+        parent = os.path.dirname(dest.path)
+        if parent != '' and not os.path.isdir(parent):
+            os.makedirs(parent)
+
+        dest.table = table.Table(dest.path, truncate=truncate)
+        dest.table.create_index('expiration')
+        dest.table_trusted = self._tables_trusted
+
+        dest.deadletter = table.Table('{}_deadletter'.format(dest.path), truncate=truncate)
+
+    def _close_destination(self, dest):
+        if dest.table is not None:
+            dest.table.close()
+            dest.table = None
+
+        if dest.deadletter is not None:
+            dest.deadletter.close()
+            dest.deadletter = None
+
+    def _start_destination(self, dest):
+        # replays what was left in the queue log at the last stop
+        dest.pending.open()
+
+        dest.push_pool = gevent.pool.Pool(self.max_inflight_batches)
+        dest.push_glet = gevent.spawn(self._push_loop, dest)
+
+    def _stop_destination(self, dest):
+        if dest.push_glet is not None:
+            dest.push_glet.kill()
+            dest.push_glet = None
+
+        if dest.push_pool is not None:
+            dest.push_pool.kill()
+            dest.push_pool = None
+
+        dest.token_cache.invalidate()
+        self._close_session(dest)
+        dest.pending.close()
+
     def connect(self, inputs, output):
         output = False
         super(Output, self).connect(inputs, output)
 
 
+    def _initialize_table(self, truncate=False, trusted=True):
+        self._tables_trusted = trusted
+        for dest in self._destinations.itervalues():
+            self._open_destination(dest, truncate=truncate)
+        self._tables_open = True
+
+        if self._ranges_table is not None:
+            self._ranges_table.close()
+
+        self._ranges_table = table.Table('{}_ranges'.format(self.name), truncate=truncate)
+        self._ranges = RangeExpander()
+        for indicator, state in self._ranges_table.query(include_value=True):
+            self._ranges.add(indicator, state['value'])
+
     def initialize(self):
-        pass
+        self._initialize_table()
 
     def rebuild(self):
-        pass
+        # after an unclean stop the tables could be behind what Graph holds
+        self._initialize_table(trusted=self.last_checkpoint is not None)
 
     def reset(self):
-        pass
-
-    def _get_auth_token(self):
-        if self.client_id is None:
-            LOG.error('{} - client_id not set'.format(self.name))
-            raise AuthConfigException('{} - client_id not set'.format(self.name))
-        if self.client_secret is None:
-            LOG.error('{} - client_secret not set'.format(self.name))
-            raise AuthConfigException('{} - client_secret not set'.format(self.name))
-        if self.tenant_id is None:
-            LOG.error('{} - tenant_id not set'.format(self.name))
-            raise AuthConfigException('{} - tenant_id not set'.format(self.name))
-
-        context = adal.AuthenticationContext(
-            AUTHORITY_URL.format(self.tenant_id),
-            validate_authority=self.tenant_id != 'adfs',
-            api_version=None
+        self._initialize_table(truncate=True)
+
+    def _get_auth_token(self, dest):
+        if dest.client_id is None:
+            LOG.error('{} - {} - client_id not set'.format(self.name, dest.name))
+            raise AuthConfigException('{} - {} - client_id not set'.format(self.name, dest.name))
+        if dest.client_secret is None:
+            LOG.error('{} - {} - client_secret not set'.format(self.name, dest.name))
+            raise AuthConfigException('{} - {} - client_secret not set'.format(self.name, dest.name))
+        if dest.tenant_id is None:
+            LOG.error('{} - {} - tenant_id not set'.format(self.name, dest.name))
+            raise AuthConfigException('{} - {} - tenant_id not set'.format(self.name, dest.name))
+
+        return dest.token_cache.get(
+            dest.tenant_id,
+            dest.client_id,
+            dest.client_secret
         )
 
-        token = context.acquire_token_with_client_credentials(
-            RESOURCE,
-            self.client_id,
-            self.client_secret
-        )
+    def _get_session(self, dest, token):
+        if dest.session is None:
+            dest.session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=self.http_pool_size
+            )
+            dest.session.mount('https://', adapter)
+            dest.session.headers.update({
+                'Content-Type': 'application/json',
+                'User-Agent': USER_AGENT
+            })
+
+        # Authorization header is swapped only when the token changes
+        if token != dest.session_token:
+            dest.session.headers['Authorization'] = 'Bearer {}'.format(token)
+            dest.session_token = token
+
+        return dest.session
+
+    def _close_session(self, dest):
+        if dest.session is not None:
+            dest.session.close()
+        dest.session = None
+        dest.session_token = None
+
+    def _submit_body(self, indicators):
+        # records carry their serialization, the body is just joined
+        return self._make_body('{"value":[' + ','.join(fragment(i) for i in indicators) + ']}')
+
+    def _delete_body(self, indicators):
+        external_ids = list(set(str(i['externalId']) for i in indicators))
+        return self._make_body(json.dumps({'value': external_ids}))
+
+    def _json_batch_body(self, deletes, submits):
+        """Returns the body of a JSON batch request deleting deletes and
+        then submitting submits. Sub-request ids are the phase names.
+        """
+        requests_ = []
+
+        if len(deletes) != 0:
+            external_ids = list(set(str(i['externalId']) for i in deletes))
+            requests_.append(
+                '{"id":"delete","method":"POST","url":"' + JSONBATCH_DELETE_URL + '",'
+                '"headers":{"Content-Type":"application/json"},'
+                '"body":' + json.dumps({'value': external_ids}) + '}'
+            )
 
-        if token is None or 'accessToken' not in token:
-            LOG.error('{} - Invalid token or accessToken not available'.format(self.name))
-            raise RuntimeError('{} - Invalid token or accessToken not available'.format(self.name))
+        if len(submits) != 0:
+            # deletes go first, like in separate requests
+            depends_on = '"dependsOn":["delete"],' if len(deletes) != 0 else ''
+            requests_.append(
+                '{"id":"submit",' + depends_on + '"method":"POST","url":"' + JSONBATCH_SUBMIT_URL + '",'
+                '"headers":{"Content-Type":"application/json"},'
+                '"body":{"value":[' + ','.join(fragment(i) for i in submits) + ']}}'
+            )
 
-        return token['accessToken']
+        return self._make_body('{"requests":[' + ','.join(requests_) + ']}')
 
-    def _push_indicators(self, token, indicators):
+    def _make_body(self, body):
+        """Returns (body, headers) of a request, compressing body when
+        http_compression is enabled.
+        """
+        if not self.http_compression or len(body) < HTTP_COMPRESSION_MIN_SIZE:
+            return body, None
 
-        message = {
-            'value': list(indicators)
-        }
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        compressed = compressor.compress(body) + compressor.flush()
+        self.statistics['http.bytes_saved'] += len(body) - len(compressed)
 
-        LOG.debug('{} - _push_indicators message is: {}'.format(self.name, message))
+        return compressed, {'Content-Encoding': 'gzip'}
 
-        result = requests.post(
+    def _push_indicators(self, dest, token, indicators, body):
+        """Submits indicators, returns the list of (externalId, reason)
+        of the indicators Graph failed to create.
+        """
+        data, headers = body
+        result = self._get_session(dest, token).post(
             ENDPOINT_SUBMITBATCH,
-            headers={
-                'Content-Type': 'application/json',
-                'Authorization': 'Bearer {}'.format(token),
-                'User-Agent': USER_AGENT
-            },
-            json=message
+            data=data,
+            headers=headers,
+            timeout=self.http_timeout
         )
 
-        LOG.debug('{} - _push_indicators result is: {}'.format(self.name, result.text))
-
         result.raise_for_status()
 
-        result = result.json()
+        return self._parse_submit_result(dest, json.loads(result.content))
+
+    def _parse_submit_result(self, dest, result):
         if not result or  '@odata.context' not in result or result['@odata.context'] != 'https://graph.microsoft.com/{}/$metadata#Collection(tiIndicator)'.format(ENDPOINT_VERSION):
             raise SecurityGraphResponseException('Unexpected response from Security Graph API')
 
         if 'value' not in result or isinstance(result['value'], list) == False or len(result['value']) < 1:
             raise SecurityGraphResponseException('Missing value from Security Graph API result')
 
+        failed = []
         for v in result['value']:
             if '@odata.type' not in v or v['@odata.type'] != '#microsoft.graph.tiIndicator' or 'id' not in v or 'externalId' not in v:
                 raise SecurityGraphResponseException('Missing indicator values from Security Graph response')
-            
-            LOG.debug('{} - Got successful id for indicator {}: {}'.format(self.name, v['externalId'], v['id']))
+
             if v['id'] != 'Failed to create, check Error element for reason':
                 # Success!
                 self.statistics['indicator.tx'] += 1
+                self._on_submitted(dest, v['externalId'], v['id'])
 
 
             else:
                 failReason = v['Error'] if 'Error' in v else 'Unknown'
                 LOG.error('{}: error creating/updating indicator {}: {}'.format(self.name, v['externalId'], failReason))
                 self.statistics['error.submit'] += 1
+                failed.append((v['externalId'], failReason))
 
+        return failed
 
-    def _delete_indicators(self, token, indicators):
-
-
-        message = {
-            'value': list(set(str(i['externalId']) for i in indicators))
-        }
-
-        LOG.debug('{} - _delete_indicators message is: {}'.format(self.name, message))
-
-        result = requests.post(
+    def _delete_indicators(self, dest, token, indicators, body):
+        """Deletes indicators by externalId, returns the list of
+        (externalId, reason) of the indicators Graph failed to delete.
+        """
+        data, headers = body
+        result = self._get_session(dest, token).post(
             ENDPOINT_DELETEBATCH,
-            headers={
-                'Content-Type': 'application/json',
-                'Authorization': 'Bearer {}'.format(token),
-                'User-Agent': USER_AGENT
-            },
-            json=message
+            data=data,
+            headers=headers,
+            timeout=self.http_timeout
         )
 
-        LOG.debug('{} - _delete_indicators result is: {}'.format(self.name, result.text))
-
         result.raise_for_status()
 
-        result = result.json()
+        return self._parse_delete_result(dest, indicators, json.loads(result.content))
+
+    def _parse_delete_result(self, dest, indicators, result):
         if not result or  '@odata.context' not in result or result['@odata.context'] != 'https://graph.microsoft.com/{}/$metadata#Collection(microsoft.graph.ResultInfo)'.format(ENDPOINT_VERSION):
             raise SecurityGraphResponseException('Unexpected response from Security Graph API')
 
         if 'value' not in result or isinstance(result['value'], list) == False or len(result['value']) < 1:
             raise SecurityGraphResponseException('Missing or incorrect value from Security Graph API result')
 
+        failed = []
         for v in result['value']:
             if 'code' not in v or 'message' not in v:
                 raise SecurityGraphResponseException('Missing code/message from Security Graph delete response')
             if v['code'] == "204":
-                LOG.debug('_delete indicators returned success (204) for indicator {}: {}'.format(v['message'].split(' ')[0], v['message']))
                 self.statistics['indicator.delete'] += 1
+            elif v['code'] == "404":
+                # already gone, nothing to retry
+                self.statistics['indicator.delete_not_found'] += 1
             else:
                 LOG.error('_delete indicators returned error ({}) for indicator {}: {}'.format(v['code'], v['message'].split(' ')[0], v['message']))
-                self.statistics['error.submit'] += 1                
+                self.statistics['error.submit'] += 1
+                failed.append((v['message'].split(' ')[0], v['message']))
+
+        failed_ids = set(external_id for external_id, _ in failed)
+        self._on_deleted(dest, [str(i['externalId']) for i in indicators if str(i['externalId']) not in failed_ids])
+
+        return failed
+
+    def _update_queue_statistics(self, dest):
+        prefix = 'destination.{}.'.format(dest.name)
+        self.statistics[prefix + 'queue.in_memory'] = dest.pending.num_keys()
+        self.statistics[prefix + 'queue.on_disk'] = dest.pending.num_spilled()
+        self.statistics[prefix + 'queue.oldest_age'] = int(dest.pending.oldest_age())
+        self.statistics[prefix + 'batch.target_size'] = dest.rate.batch_size
+
+        destinations = self._destinations.values()
+        self.statistics['queue.in_memory'] = sum(d.pending.num_keys() for d in destinations)
+        self.statistics['queue.on_disk'] = sum(d.pending.num_spilled() for d in destinations)
+        self.statistics['queue.oldest_age'] = max(int(d.pending.oldest_age()) for d in destinations)
+        self.statistics['batch.target_size'] = min(d.rate.batch_size for d in destinations)
+
+        self.statistics['encoder.buffer'] = len(self._encode_buffer)
+
+        for lane, _ in LANE_WEIGHTS:
+            self.statistics['lane.{}.depth'.format(lane)] = 0
+        for d in destinations:
+            for lane, depth in d.pending.lane_depths().iteritems():
+                self.statistics['lane.{}.depth'.format(lane)] += depth
+
+        self._update_backpressure()
+
+    def _update_backpressure(self):
+        """Sets the sub state of the node to WARNING when the queue goes
+        over the high watermark, and back when it is under the low one.
+        """
+        if self.queue_high_watermark <= 0:
+            return
+
+        length = self.length()
+        if not self._backpressure and length >= self.queue_high_watermark:
+            LOG.warning('{} - {} operations queued, over the high watermark'.format(self.name, length))
+            self._backpressure = True
+            self.sub_state = 'WARNING'
+            self.sub_state_message = 'queue over the high watermark ({})'.format(self.queue_high_watermark)
+            self.statistics['queue.backpressure_on'] += 1
+
+        elif self._backpressure and length <= self.queue_low_watermark:
+            LOG.info('{} - {} operations queued, under the low watermark'.format(self.name, length))
+            self._backpressure = False
+            self.sub_state = None
+            self.sub_state_message = None
+
+        self.statistics['queue.backpressure'] = 1 if self._backpressure else 0
+
+    def _push_loop(self, dest):
+        while True:
+            try:
+                self._update_queue_statistics(dest)
+                dest.push_pool.wait_available()
+
+                # the same externalId is never in two in-flight batches, so a
+                # delete can't overtake a newer create for the same indicator
+                batch = dest.pending.get_batch(dest.rate.batch_size, busy=dest.inflight)
+                if len(batch) == 0:
+                    # entries waiting for a retry don't wake us up
+                    dest.pending.wait(timeout=1.0)
+                    continue
+
+                for entry in batch:
+                    dest.inflight[entry.key] = entry.records
+                    dest.inflight_records += len(entry.records)
+                dest.push_pool.spawn(self._send_batch, dest, batch)
+
+            except gevent.GreenletExit:
+                return
+
+            except Exception as e:
+                # e.g. a corrupted line in the queue log, the cursor is past it
+                LOG.exception('{} - {} - error in push loop - {}'.format(self.name, dest.name, str(e)))
+                self.statistics['error.push_loop'] += 1
+                gevent.sleep(1.0)
+
+    def _is_delete(self, indicator):
+        return indicator.get('expirationDateTime', None) == EXPIRED
+
+    def _is_published(self, dest, external_id):
+        # without a reliable record of what has been pushed, assume it is in Graph
+        if not dest.table_trusted or external_id in dest.inflight:
+            return True
+        return dest.table.get(external_id) is not None
+
+    def _content_hash(self, records):
+        # the same for every destination, their own fields are left out
+        return content_hash(records, HASH_EXCLUDED_FIELDS)
+
+    def _is_unchanged(self, dest, external_id, content_hash):
+        if not dest.table_trusted or external_id in dest.pending or external_id in dest.inflight:
+            return False
+
+        state = dest.table.get(external_id)
+        if state is None:
+            return False
+
+        # what Graph holds is stale, the next update is sent anyway
+        if state.get('dead_letter', False):
+            return False
+
+        # tenant, client, action or targetProduct changed since the
+        # indicator was pushed
+        if state.get('fingerprint', None) != dest.fingerprint:
+            return False
+
+        return state['hash'] == content_hash
+
+    def _on_submitted(self, dest, external_id, graph_id):
+        self._clear_dead_letter(dest, external_id)
+
+        records = dest.inflight.get(external_id, None)
+        if records is None or dest.table is None:
+            return
+
+        expiration = datetime.strptime(records[0]['expirationDateTime'][:19], '%Y-%m-%dT%H:%M:%S')
+        dest.table.put(external_id, {
+            'hash': self._content_hash(records),
+            'fingerprint': dest.fingerprint,
+            'graph_id': graph_id,
+            'expiration': calendar.timegm(expiration.timetuple()),
+            'records': records
+        })
+
+    def _refresh_loop(self):
+        while True:
+            try:
+                gevent.sleep(self.refresh_interval)
+                self._refresh_expiring()
+
+            except gevent.GreenletExit:
+                return
+
+            except Exception as e:
+                LOG.exception('{} - error refreshing expiring indicators - {}'.format(self.name, str(e)))
+                self.statistics['error.refresh'] += 1
+
+    def _refresh_expiring(self):
+        for dest in self._destinations.values():
+            self._refresh_destination(dest)
+
+    def _refresh_destination(self, dest):
+        if dest.table is None:
+            return
+
+        # budget for this run, the oldest expirations come first
+        budget = max(int(self.refresh_rate * self.refresh_interval), 1)
+
+        expiring = dest.table.query(
+            index='expiration',
+            to_key=int(time.time() + self.refresh_lead),
+            include_value=True
+        )
+        for external_id, state in expiring:
+            if budget <= 0:
+                break
+
+            # a newer operation is already on its way
+            if external_id in dest.pending or external_id in dest.inflight:
+                continue
+
+            try:
+                dest.pending.put(external_id, self._refreshed_records(dest, external_id, state), delete=False,
+                                 lane=LANE_REFRESH)
+            except Full:
+                break
+
+            self.statistics['refresh.queued'] += 1
+            budget -= 1
 
-    def _push_loop(self):
+    def _refreshed_records(self, dest, external_id, state):
+        # records from the state table with a new expiration, the fields
+        # they were pushed with are replaced by the current ones
+        expiration = self._encoder.expiration(external_id)
+
+        records = []
+        for r in state['records']:
+            r = EncodedRecord((k, v) for k, v in r.iteritems() if k not in DESTINATION_FIELDS)
+            r['expirationDateTime'] = expiration
+            records.append(r)
+
+        return dest.records(records)
+
+    def _reconcile_loop(self):
         while True:
-            msg = self._queue.get()
+            try:
+                gevent.sleep(self.reconcile_interval)
+                self._start_reconcile()
+
+            except gevent.GreenletExit:
+                return
+
+    def _start_reconcile(self):
+        if self._reconcile_glet is not None and not self._reconcile_glet.ready():
+            return False
+
+        self._reconcile_glet = gevent.spawn(self._reconcile)
+        return True
+
+    def _reconcile(self):
+        for dest in self._destinations.values():
+            self._reconcile_destination(dest)
+
+    def _reconcile_destination(self, dest):
+        """Compares the tiIndicators Graph holds for the destination
+        target_product with its state table. Indicators unknown to the
+        node are deleted, and indicators missing from Graph are submitted
+        again. Both go through the pending queue. Only indicators carrying
+        the node tag are deleted, the target_product may be shared with
+        other nodes or tools.
+        """
+        if dest.table is None:
+            return
+
+        LOG.info('{} - {} - reconciliation started'.format(self.name, dest.name))
+        self.statistics['reconcile.run'] += 1
 
-            LOG.debug('{} - push_loop dequeued first indicator {!r}'.format(self.name, msg))
+        # without a reliable record of what has been pushed nothing can be
+        # called an orphan, only the missing indicators are fixed
+        delete_orphans = dest.table_trusted
+        if not delete_orphans:
+            LOG.info('{} - {} - state table not trusted, orphans will not be deleted'.format(self.name, dest.name))
+
+        seen = ExternalIdSet()
+        num_orphans = 0
+        num_missing = 0
+
+        try:
+            for v in self._list_indicators(dest):
+                external_id = v.get('externalId', None)
+                if external_id is None:
+                    self.statistics['reconcile.no_external_id'] += 1
+                    continue
+
+                seen.add(external_id)
+                self.statistics['reconcile.listed'] += 1
+
+                # a newer operation is already on its way
+                if not delete_orphans or external_id in dest.pending or external_id in dest.inflight:
+                    continue
+
+                if dest.table.get(external_id) is not None:
+                    continue
+
+                # pushed by someone else
+                if self.node_tag not in (v.get('tags', None) or []):
+                    self.statistics['reconcile.foreign'] += 1
+                    continue
+
+                dest.pending.put(
+                    external_id,
+                    [EncodedRecord(externalId=external_id, expirationDateTime=EXPIRED)],
+                    delete=True,
+                    lane=LANE_REFRESH
+                )
+                num_orphans += 1
+
+            seen.freeze()
+
+            for external_id, state in dest.table.query(include_value=True):
+                if external_id in seen or external_id in dest.pending or external_id in dest.inflight:
+                    continue
+
+                dest.pending.put(external_id, self._refreshed_records(dest, external_id, state), delete=False,
+                                 lane=LANE_REFRESH)
+                num_missing += 1
+
+        except gevent.GreenletExit:
+            raise
+
+        except Full:
+            LOG.error('{} - {} - queue full, reconciliation aborted'.format(self.name, dest.name))
+            self.statistics['error.queue_full'] += 1
 
+        except Exception as e:
+            LOG.exception('{} - {} - error during reconciliation - {}'.format(self.name, dest.name, str(e)))
+            self.statistics['error.reconcile'] += 1
+
+        self.statistics['reconcile.orphans'] += num_orphans
+        self.statistics['reconcile.missing'] += num_missing
+
+        LOG.info('{} - {} - reconciliation done, {} indicators listed, {} orphans, {} missing'.format(
+            self.name, dest.name, len(seen), num_orphans, num_missing
+        ))
+
+    def _list_indicators(self, dest):
+        """Yields the tiIndicators of the destination target_product, one
+        page at a time.
+        """
+        url = ENDPOINT_URL
+        params = {
+            '$filter': "targetProduct eq '{}'".format(dest.target_product),
+            '$select': 'id,externalId,tags',
+            '$top': self.reconcile_page_size
+        }
+
+        while url is not None:
+            page = self._get_page(dest, url, params)
+            for v in page.get('value', []):
+                yield v
+
+            # the next link already carries the query
+            url = page.get('@odata.nextLink', None)
+            params = None
+
+    def _get_page(self, dest, url, params):
+        retries = 0
+        while True:
+            dest.rate.acquire()
+
+            try:
+                result = self._get_session(dest, self._get_auth_token(dest)).get(
+                    url,
+                    params=params,
+                    timeout=self.http_timeout
+                )
+                result.raise_for_status()
+
+                return json.loads(result.content)
+
+            except HTTPError as e:
+                status_code = e.response.status_code
+
+                if status_code in [429, 503]:
+                    dest.rate.on_throttle(
+                        retry_after=parse_retry_after(e.response.headers.get('Retry-After', None)),
+                        attempt=retries + 1
+                    )
+                    self.statistics['error.throttled'] += 1
+                    continue
+
+                if status_code == 401:
+                    dest.token_cache.invalidate()
+                elif status_code >= 400 and status_code < 500:
+                    raise
+
+            except RequestException as e:
+                LOG.error('{} - error listing indicators - {}'.format(self.name, str(e)))
+
+            retries += 1
+            if retries > self.max_retries:
+                raise RuntimeError('{} - giving up listing indicators after {} retries'.format(self.name, self.max_retries))
+
+            gevent.sleep(dest.rate.backoff(retries))
+
+    def _on_deleted(self, dest, external_ids):
+        if dest.table is None:
+            return
+
+        for external_id in external_ids:
+            dest.table.delete(external_id)
+            self._clear_dead_letter(dest, external_id)
+
+    def _send_batch(self, dest, batch):
+        try:
             artifacts = []
-            artifacts.append(msg)
+            for entry in batch:
+                artifacts.extend(entry.records)
+            self._batch_sizes.observe(len(artifacts))
+
+            trace = self._tracer.start('batch', destination=dest.name, entries=len(batch), records=len(artifacts))
+            if trace is not None:
+                lanes = {}
+                for entry in batch:
+                    lanes[entry.lane] = lanes.get(entry.lane, 0) + 1
+                queued_at = [entry.queued_at for entry in batch if entry.queued_at is not None]
+                trace.event(
+                    'dequeued',
+                    lanes=lanes,
+                    max_wait_ms=int((time.time() - min(queued_at)) * 1000) if len(queued_at) != 0 else None
+                )
 
+            failed = self._send_batch_with_retries(dest, artifacts, trace=trace)
+            if len(failed) != 0:
+                self._handle_failed(dest, batch, failed)
+
+            if trace is not None:
+                self._tracer.finish(trace, failed=[[external_id, str(reason)] for external_id, reason, _ in failed])
+
+            failed_ids = set(external_id for external_id, _, _ in failed)
+            now = time.time()
+            for entry in batch:
+                if entry.queued_at is not None and entry.key not in failed_ids:
+                    self._lane_latencies[entry.lane].observe(now - entry.queued_at)
+
+            # if the greenlet is killed the entries stay in the log and
+            # are sent again at the next start
+            dest.pending.ack(batch)
+
+        finally:
+            for entry in batch:
+                records = dest.inflight.pop(entry.key, None)
+                if records is not None:
+                    dest.inflight_records -= len(records)
+            dest.pending.notify()
+            self._batch_done.set()
+
+    def _send_batch_with_retries(self, dest, artifacts, trace=None):
+        # Determine which indicators must be added and which ones must be deleted
+        indicatorsToDelete=deque()
+        indicatorsToCreateUpdate=deque()
+
+        for i in artifacts:
+            if self._is_delete(i):
+                indicatorsToDelete.append(i)
+            else:
+                indicatorsToCreateUpdate.append(i)
+
+        if trace is not None:
+            trace.event('split', create_update=len(indicatorsToCreateUpdate), delete=len(indicatorsToDelete))
+
+        failed = []
+
+        # both in one round trip, what does not go through is sent again
+        # with separate requests below
+        if self.http_batching and len(indicatorsToDelete) > 0 and len(indicatorsToCreateUpdate) > 0:
+            failed, indicatorsToDelete, indicatorsToCreateUpdate = self._send_json_batch(
+                dest, list(indicatorsToDelete), list(indicatorsToCreateUpdate), trace=trace
+            )
+
+        # Delete expired indicators before creating new ones
+        if len(indicatorsToDelete) > 0:
+            failed.extend(self._send_with_retries(dest, self._delete_indicators, self._delete_body, list(indicatorsToDelete), 'delete', trace=trace))
+
+        if len(indicatorsToCreateUpdate) > 0:
+            failed.extend(self._send_with_retries(dest, self._push_indicators, self._submit_body, list(indicatorsToCreateUpdate), 'create/update', trace=trace))
+
+        return failed
+
+    def _send_json_batch(self, dest, deletes, submits, trace=None):
+        """Sends deletes and submits as the sub-requests of a single JSON
+        batch request, the submit depending on the delete. Makes a single
+        attempt and returns (failed, deletes, submits), deletes and submits
+        being the indicators of the sub-requests that did not go through.
+        """
+        body = self._json_batch_body(deletes, submits)
+
+        # Graph throttles each sub-request on its own
+        for _ in range(2):
+            self._rate_wait_timing.observe(dest.rate.acquire())
+
+        self.statistics['batch.json'] += 1
+
+        try:
+            t0 = time.time()
+            token = self._get_auth_token(dest)
+            self._token_timing.observe(time.time() - t0)
+
+            data, headers = body
+            if trace is not None:
+                trace.event('request', phase='batch', indicators=len(deletes) + len(submits), bytes=len(data))
+
+            t0 = time.time()
+            result = self._get_session(dest, token).post(
+                ENDPOINT_JSONBATCH,
+                data=data,
+                headers=headers,
+                timeout=self.http_timeout
+            )
+
+            result.raise_for_status()
+
+            latency = time.time() - t0
+            self._request_timings['batch'].observe(latency)
+            dest.rate.on_success(latency)
+
+            result = json.loads(result.content)
+            if not result or not isinstance(result.get('responses', None), list):
+                raise SecurityGraphResponseException('Missing responses from Security Graph batch result')
+
+            if trace is not None:
+                trace.event(
+                    'response',
+                    phase='batch',
+                    ms=int(latency * 1000),
+                    status=dict((str(r.get('id', None)), r.get('status', None)) for r in result['responses'])
+                )
+
+        except gevent.GreenletExit:
+            raise
+
+        except HTTPError as e:
+            status_code = e.response.status_code
+            LOG.error('{} - {} - {} error in batch request - {}'.format(self.name, dest.name, status_code, e.response.text))
+            if trace is not None:
+                trace.event('http_error', phase='batch', status=status_code)
+            self._on_json_batch_error(dest, status_code, e.response.headers)
+            self.statistics['batch.json_fallback'] += 2
+            return [], deletes, submits
+
+        except Exception as e:
+            LOG.exception('{} - {} - error in batch request - {}'.format(self.name, dest.name, str(e)))
+            if trace is not None:
+                trace.event('error', phase='batch', error=str(e))
+            self.statistics['error.batch'] += 1
+            self.statistics['batch.json_fallback'] += 2
+            return [], deletes, submits
+
+        responses = dict((str(r.get('id', None)), r) for r in result['responses'])
+        failed = []
+
+        body = self._json_batch_response(dest, responses.get('delete', None), 'delete')
+        if body is not None:
             try:
-                while len(artifacts) < MAX_BATCH_SIZE:
-                    m = self._queue.get_nowait()
-                    artifacts.append(m)
-                    LOG.debug('{} - push_loop dequeued additional indicator {!r}'.format(self.name, m))                    
-            except Empty:
-                pass
-
-            # Determine which indicators must be added and which ones must be deleted
-            indicatorsToDelete=deque()
-            indicatorsToCreateUpdate=deque()
-
-            for i in artifacts:
-                if 'expirationDateTime' in i and i['expirationDateTime'] == EXPIRED:
-                    indicatorsToDelete.append(i)
+                failed.extend(
+                    (external_id, reason, FAILED_ITEM)
+                    for external_id, reason in self._parse_delete_result(dest, deletes, body)
+                )
+            except SecurityGraphResponseException as e:
+                LOG.error('{} - Graph Security API error in batched delete request - {}'.format(self.name, str(e)))
+                self.statistics['error.submit'] += 1
+                failed.extend((i['externalId'], str(e), FAILED_TRANSIENT) for i in deletes)
+            deletes = []
+
+        body = self._json_batch_response(dest, responses.get('submit', None), 'create/update')
+        if body is not None:
+            try:
+                failed.extend(
+                    (external_id, reason, FAILED_ITEM)
+                    for external_id, reason in self._parse_submit_result(dest, body)
+                )
+            except SecurityGraphResponseException as e:
+                LOG.error('{} - Graph Security API error in batched create/update request - {}'.format(self.name, str(e)))
+                self.statistics['error.submit'] += 1
+                failed.extend((i['externalId'], str(e), FAILED_TRANSIENT) for i in submits)
+            submits = []
+
+        self.statistics['batch.json_fallback'] += int(len(deletes) != 0) + int(len(submits) != 0)
+
+        return failed, deletes, submits
+
+    def _json_batch_response(self, dest, response, phase):
+        """Returns the body of a successful sub-request response, None if
+        the sub-request has to be sent again.
+        """
+        if response is None:
+            LOG.error('{} - {} - missing {} response in batch result'.format(self.name, dest.name, phase))
+            self.statistics['error.batch'] += 1
+            return None
+
+        status_code = int(response.get('status', 0))
+        if status_code >= 200 and status_code < 300:
+            body = response.get('body', None)
+            if isinstance(body, basestring):
+                body = json.loads(body)
+            return body
+
+        # 424, the delete it depends on failed and it was not executed
+        if status_code != 424:
+            LOG.error('{} - {} - {} error in batched {} request - {}'.format(self.name, dest.name, status_code, phase, response.get('body', None)))
+            self._on_json_batch_error(dest, status_code, response.get('headers', None) or {})
+
+        return None
+
+    def _on_json_batch_error(self, dest, status_code, headers):
+        if status_code in [429, 503]:
+            dest.rate.on_throttle(retry_after=parse_retry_after(headers.get('Retry-After', None)))
+            self.statistics['error.throttled'] += 1
+            return
+
+        if status_code == 401:
+            dest.token_cache.invalidate()
+
+        self.statistics['error.batch'] += 1
+
+    def _handle_failed(self, dest, batch, failed):
+        entries = dict((entry.key, entry) for entry in batch)
+
+        for external_id, reason, kind in failed:
+            entry = entries.pop(external_id, None)
+            if entry is None:
+                continue
+
+            # Graph could not be reached, that says nothing about the
+            # indicator: it waits as long as the longest retry and keeps
+            # its attempts
+            if kind == FAILED_TRANSIENT:
+                attempts = entry.attempts
+                not_before = time.time() + dest.rate.backoff(self.max_retries)
+            else:
+                attempts = entry.attempts + 1
+                if kind == FAILED_PERMANENT or attempts >= self.max_item_attempts:
+                    self._dead_letter(dest, entry, reason, attempts)
+                    continue
+                not_before = time.time() + dest.rate.backoff(attempts)
+
+            # a newer operation for the same indicator supersedes this one
+            if external_id in dest.pending:
+                continue
+
+            try:
+                dest.pending.put(
+                    external_id,
+                    entry.records,
+                    delete=entry.delete,
+                    attempts=attempts,
+                    not_before=not_before,
+                    lane=entry.lane
+                )
+                if kind == FAILED_TRANSIENT:
+                    self.statistics['indicator.requeued_transient'] += 1
                 else:
-                    indicatorsToCreateUpdate.append(i)
+                    self.statistics['indicator.requeued'] += 1
 
-            LOG.info('{} - _push_loop has a total of {} indicators to create/update and {} to delete'.format(self.name, len(indicatorsToCreateUpdate), len(indicatorsToDelete)))
+            except Full:
+                self._dead_letter(dest, entry, 'queue full', attempts)
 
+    def _replay_dead_letters(self):
+        """Queues again the operations of the dead-letter tables, with a
+        fresh attempt budget. Returns the number of operations queued.
+        """
+        num_queued = 0
 
-            # Retry loop for pushing/deleting indicators
-            while True:
-                retries = 0
+        for dest in self._destinations.values():
+            if dest.deadletter is None or dest.deadletter.num_indicators == 0:
+                continue
 
-                try:
+            replayed = []
+            try:
+                for external_id, letter in dest.deadletter.query(include_value=True):
+                    replayed.append(external_id)
 
-                    # Get authentication token first
-                    token = self._get_auth_token()
-                    LOG.debug('{} - token: {}'.format(self.name, token))
-
-                    # Delete expired indicators before creating new ones
-                    if len(indicatorsToDelete) > 0:
-                        LOG.debug('{} - Deleting {} indicators'.format(self.name, len(indicatorsToDelete)))
-
-                        try:
-                            self._delete_indicators(
-                                token=token,
-                                indicators=indicatorsToDelete
-                            )
-                            # Indicators successfully deleted, empty the list
-                            indicatorsToDelete=[]
-
-                        # HTTP Error to track 4xx during the delete phase, with no retry
-                        except HTTPError as e:
-                            LOG.debug('{} - error deleting indicators - {}'.format(self.name, str(e)))
-                            status_code = e.response.status_code
-
-                            # If it's a 4xx, don't retry, else throw it up and go in the retry loop
-                            if status_code >= 400 and status_code < 500:
-                                LOG.error('{}: {} error in delete request - {}'.format(self.name, status_code, e.response.text))
-                                self.statistics['error.invalid_request'] += 1
-                                # this way it will continue to the create/update phase without retrying the delete in the next loop
-                                indicatorsToDelete=[]
-                            else:
-                                raise HTTPError(e)
-
-                        # SecurityGraph response error shouldn't trigger a retry
-                        except SecurityGraphResponseException as e:
-                            LOG.exception('{} - Graph Security API error deleting indicators - {}'.format(self.name, str(e)))
-                            self.statistics['error.submit'] += 1
-                            break
-
-                    if len(indicatorsToCreateUpdate) > 0:
-                        LOG.debug('{} - Creating/Updating {} indicators'.format(self.name, len(indicatorsToCreateUpdate)))
-
-                        try:
-                            self._push_indicators(
-                                token=token,
-                                indicators=indicatorsToCreateUpdate
-                            )
-
-                        # HTTP Error to track 4xx during the delete phase, with no retry
-                        except HTTPError as e:
-                            LOG.debug('{} - error creating/updating indicators - {}'.format(self.name, str(e)))
-                            status_code = e.response.status_code
-
-                            # If it's a 4xx, don't retry, else throw it up and go in the retry loop
-                            if status_code >= 400 and status_code < 500:
-                                LOG.error('{}: {} error in create/update request - {}'.format(self.name, status_code, e.response.text))
-                                self.statistics['error.invalid_request'] += 1
-                                # this way it will continue to the delete phase without retrying the create in the next loop
-                                indicatorsToCreateUpdate=[]
-                            else:
-                                raise HTTPError(e)
-
-                        # SecurityGraph response error shouldn't trigger a retry
-                        except SecurityGraphResponseException as e:
-                            LOG.exception('{} - Graph Securty API error creating/updating indicators - {}'.format(self.name, str(e)))
-                            self.statistics['error.submit'] += 1
-                            break
-
-                    # Successful loop
-                    break
+                    # a newer operation for the same indicator supersedes this one
+                    if external_id in dest.pending or external_id in dest.inflight:
+                        continue
 
-                # Graceful Exit
-                except gevent.GreenletExit:
-                    return
+                    dest.pending.put(
+                        external_id,
+                        [EncodedRecord(r) for r in letter['records']],
+                        delete=letter['delete'],
+                        lane=LANE_WITHDRAW if letter['delete'] else LANE_UPDATE
+                    )
+                    num_queued += 1
 
-                # Authentication error during token generation
-                except AuthConfigException as e:
-                    LOG.exception('{} - Error submitting indicators - {}'.format(self.name, str(e)))
-                    self.statistics['error.submit'] += 1
-                    gevent.sleep(60.0)
+            except Full:
+                replayed.pop()
+                LOG.error('{} - {} - queue full, dead-letter replay stopped'.format(self.name, dest.name))
+                self.statistics['error.queue_full'] += 1
 
-                # Other error, implement a retry logic
-                # Note that if this hits during the delete phase, the createUpdate is never triggered
-                except Exception as e:
-                    LOG.exception('{} - error submitting indicators - {}'.format(self.name, str(e)))
-                    self.statistics['error.submit'] += 1
-                    retries += 1
-                    if retries > 5:
-                        break
-                    gevent.sleep(120.0)
+            for external_id in replayed:
+                dest.deadletter.delete(external_id)
 
-            gevent.sleep(0.1)
+        LOG.info('{} - {} dead-lettered operations queued again'.format(self.name, num_queued))
+        self.statistics['deadletter.replayed'] += num_queued
 
-    def _encode_indicator(self, indicator, value, expired=False):
-        type_ = value['type']
+        return num_queued
 
-        if type_ not in [ 'URL', 'domain', 'md5', 'sha256', 'sha1', 'IPv4' ]:
-            self.statistics['error.unhandled_type'] += 1
-            raise RuntimeError('{} - Unhandled {}'.format(self.name, type_))
+    def _clear_dead_letter(self, dest, external_id):
+        if dest.deadletter is None or dest.deadletter.num_indicators == 0:
+            return
 
+        dest.deadletter.delete(external_id)
 
-        description = '{} indicator from {}'.format(
-            type_,
-            ', '.join(value['sources'])
-        )
-        external_id = '{}:{}'.format(type_, indicator)
-        expiration = datetime.utcnow() + timedelta(days=29)
-        if expired:
-            expiration = datetime.fromtimestamp(0)
-        expiration = expiration.isoformat()
-
-        indicators = []
-        if type_ == 'IPv4' and '-' in indicator:
-            a1, a2 = indicator.split('-', 1)
-            r = netaddr.IPRange(a1, a2).cidrs()
-            indicators = [str(i) for i in r ]
-        else:
-            indicators = [indicator]
+    def _dead_letter(self, dest, entry, reason, attempts):
+        LOG.error('{} - {} - giving up on indicator {} after {} attempts: {}'.format(self.name, dest.name, entry.key, attempts, reason))
+        self.statistics['indicator.dead_letter'] += 1
 
-        result = []
-        for i in indicators:
-            r = {
-                'description': description,
-                'confidence': value['confidence'],
-                'externalId': external_id,
-                'indicator': indicator,
-                'expirationDateTime': expiration,
-                'tlpLevel': SHARE_LEVEL_2_ISG.get(value.get('share_level', 'unknown'), 0),
-                'threatType': self.threat_type
-            }
-
-            if self.recommended_action is not None:
-                r['action'] = self.recommended_action
-
-            if self.target_product is not None:
-                r['targetProduct'] = self.target_product
-
-            if type_ == 'URL':
-                r['url'] = i
-            elif type_ == 'domain':
-                r['domainName'] = i
-            elif type_ in ['md5', 'sha256', 'sha1']:
-                r['fileHashType'] = HASH_2_ISG[type_]
-                r['fileHashValue'] = i
-            elif type_ == 'IPv4':
-                parsed = netaddr.IPNetwork(i)
-                if parsed.size == 1 and '/' not in i:
-                    r['networkIPv4'] = i
-                else:
-                    r['networkCidrBlock'] = i
-            else:
-                # Unsupported indicator type, should never reach this code
+        if not entry.delete:
+            self._park_state(dest, entry.key)
+
+        if dest.deadletter is None:
+            return
+
+        dest.deadletter.put(entry.key, {
+            'delete': entry.delete,
+            'records': entry.records,
+            'reason': str(reason),
+            'attempts': attempts,
+            'timestamp': int(time.time())
+        })
+
+    def _park_state(self, dest, external_id):
+        # otherwise the row keeps its expiration and the scheduler would pick
+        # it again at every run, using the budget of the live indicators
+        if dest.table is None:
+            return
+
+        state = dest.table.get(external_id)
+        if state is None:
+            return
+
+        state['expiration'] = int(time.time() + self.indicator_ttl)
+        state['dead_letter'] = True
+        dest.table.put(external_id, state)
+        self.statistics['refresh.dead_letter'] += 1
+
+    def _send_with_retries(self, dest, send, make_body, indicators, phase, trace=None):
+        """Sends indicators with send, retrying on transient errors.
+        The request body is built once with make_body and reused by the
+        retries. Returns the list of (externalId, reason, kind) of the
+        indicators that could not be handled, kind being one of the
+        FAILED_ constants. Attempts and errors are
+        recorded in trace, if the batch is sampled.
+        """
+        body = make_body(indicators)
+
+        request_timing = self._request_timings[phase]
+
+        # Retry loop for pushing/deleting indicators
+        retries = 0
+        while True:
+            self._rate_wait_timing.observe(dest.rate.acquire())
+
+            try:
+                # Get authentication token first
+                t0 = time.time()
+                token = self._get_auth_token(dest)
+                self._token_timing.observe(time.time() - t0)
+
+                if trace is not None:
+                    trace.event('request', phase=phase, indicators=len(indicators), bytes=len(body[0]), retries=retries)
+
+                t0 = time.time()
+                failed = send(
+                    dest=dest,
+                    token=token,
+                    indicators=indicators,
+                    body=body
+                )
+                latency = time.time() - t0
+                request_timing.observe(latency)
+                dest.rate.on_success(latency)
+
+                if trace is not None:
+                    trace.event('response', phase=phase, ms=int(latency * 1000), failed=len(failed))
+
+                # Successful loop
+                return [(external_id, reason, FAILED_ITEM) for external_id, reason in failed]
+
+            # Graceful Exit
+            except gevent.GreenletExit:
+                raise
+
+            # Authentication error during token generation
+            except AuthConfigException as e:
+                LOG.exception('{} - Error submitting indicators - {}'.format(self.name, str(e)))
+                if trace is not None:
+                    trace.event('error', phase=phase, error=str(e))
+                self.statistics['error.submit'] += 1
+                gevent.sleep(60.0)
                 continue
 
-            LOG.debug('{!r} - add indicator {!r} to queue'.format(self.name, r))
+            except HTTPError as e:
+                status_code = e.response.status_code
+                if trace is not None:
+                    trace.event('http_error', phase=phase, status=status_code)
+
+                # Throttled, wait what Graph asks and retry without using a retry
+                if status_code in [429, 503]:
+                    retry_after = dest.rate.on_throttle(
+                        retry_after=parse_retry_after(e.response.headers.get('Retry-After', None)),
+                        attempt=retries + 1
+                    )
+                    LOG.info('{} - {} - {} in {} request, retrying in {:.1f}s'.format(self.name, dest.name, status_code, phase, retry_after))
+                    self.statistics['error.throttled'] += 1
+                    continue
+
+                # Token revoked or expired early, drop the cached token and retry
+                if status_code == 401:
+                    LOG.error('{}: {}: 401 error in {} request, invalidating token cache'.format(self.name, dest.name, phase))
+                    dest.token_cache.invalidate()
+
+                # Batch too large, split it and send the halves
+                elif status_code == 413 and len(indicators) > 1:
+                    LOG.info('{} - batch of {} indicators too large, splitting'.format(self.name, len(indicators)))
+                    self.statistics['batch.split'] += 1
+                    dest.rate.on_error()
+                    half = len(indicators) // 2
+                    return self._send_with_retries(dest, send, make_body, indicators[:half], phase, trace=trace) + \
+                        self._send_with_retries(dest, send, make_body, indicators[half:], phase, trace=trace)
+
+                # Missing ThreatIndicators permission, nothing is wrong with the
+                # indicators: wait for the configuration to be fixed, as for
+                # missing credentials
+                elif status_code == 403:
+                    LOG.error('{}: {}: 403 error in {} request, check the application permissions - {}'.format(self.name, dest.name, phase, e.response.text))
+                    self.statistics['error.forbidden'] += 1
+                    gevent.sleep(60.0)
+                    continue
+
+                # Invalid payload, don't retry, bisect the batch to isolate the bad indicators
+                elif status_code in [400, 422]:
+                    LOG.error('{}: {} error in {} request - {}'.format(self.name, status_code, phase, e.response.text))
+                    self.statistics['error.invalid_request'] += 1
+
+                    if len(indicators) == 1:
+                        return [(indicators[0]['externalId'], '{} {}'.format(status_code, e.response.text), FAILED_PERMANENT)]
+
+                    self.statistics['batch.bisect'] += 1
+                    half = len(indicators) // 2
+                    return self._send_with_retries(dest, send, make_body, indicators[:half], phase, trace=trace) + \
+                        self._send_with_retries(dest, send, make_body, indicators[half:], phase, trace=trace)
+
+                else:
+                    LOG.error('{}: {} error in {} request - {}'.format(self.name, status_code, phase, e.response.text))
+                    self.statistics['error.submit'] += 1
+                    dest.rate.on_error()
+
+            # SecurityGraph response error shouldn't trigger a retry of the batch,
+            # the indicators are queued again
+            except SecurityGraphResponseException as e:
+                LOG.exception('{} - Graph Security API error in {} request - {}'.format(self.name, phase, str(e)))
+                if trace is not None:
+                    trace.event('error', phase=phase, error=str(e))
+                self.statistics['error.submit'] += 1
+                return [(i['externalId'], str(e), FAILED_TRANSIENT) for i in indicators]
+
+            # Other error, implement a retry logic
+            except Exception as e:
+                LOG.exception('{} - {} - error submitting indicators - {}'.format(self.name, dest.name, str(e)))
+                if trace is not None:
+                    trace.event('error', phase=phase, error=str(e))
+                self.statistics['error.submit'] += 1
+                dest.rate.on_error()
+
+            retries += 1
+            if retries > self.max_retries:
+                LOG.error('{} - giving up on {} request for {} indicators after {} retries'.format(self.name, phase, len(indicators), self.max_retries))
+                self.statistics['error.retries_exhausted'] += 1
+                return [(i['externalId'], 'retries exhausted', FAILED_TRANSIENT) for i in indicators]
+
+            self.statistics['request.retries'] += 1
+            backoff = dest.rate.backoff(retries)
+            self._backoff_timing.observe(backoff)
+            if trace is not None:
+                trace.event('backoff', phase=phase, ms=int(backoff * 1000))
+            gevent.sleep(backoff)
+
+    def _configure_encoder(self):
+        # action and targetProduct are added per destination
+        encoder_args = dict(
+            threat_type=self.threat_type,
+            tags=[self.node_tag],
+            ttl=self.indicator_ttl,
+            ttl_jitter=self.indicator_ttl_jitter
+        )
+        self._encoder = IndicatorEncoder(**encoder_args)
 
-            result.append(r)
+        # sent along each request, workers rebuild their encoder when it changes
+        self._encoder_config = {
+            'encoder': encoder_args,
+            'hash_exclude': HASH_EXCLUDED_FIELDS
+        }
+
+    def _encode_indicator(self, indicator, value, expired=False, external_id=None):
+        t0 = time.time()
+        result = self._encoder.encode(indicator, value, expired=expired, external_id=external_id)
+        self._encode_timing.observe(time.time() - t0)
+        if result is None:
+            self.statistics['error.unhandled_type'] += 1
+            raise RuntimeError('{} - Unhandled {}'.format(self.name, value['type']))
 
         return result
 
     def _checkpoint_check(self, source=None, value=None):
         t0 = time.time()
 
-        while ((time.time() - t0) < 30) and self._queue.qsize() != 0:
-            gevent.sleep(0.5)
-        self._push_glet.kill()
+        # no new work from the node itself while draining
+        self._refresh_glet.kill()
+        if self._reconcile_loop_glet is not None:
+            self._reconcile_loop_glet.kill()
+        if self._reconcile_glet is not None:
+            self._reconcile_glet.kill()
+
+        # the push loop keeps sending at full concurrency, wake up at the
+        # end of every batch until nothing is left or the deadline passes
+        deadline = t0 + self.checkpoint_timeout
+        while True:
+            self._batch_done.clear()
+            if self.length() == 0:
+                break
+
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+
+            self._batch_done.wait(timeout=remaining)
 
-        LOG.debug('{} - checkpoint with {} elements in the queue'.format(self.name, self._queue.qsize()))
+        # what the workers have not encoded yet goes to the queue log
+        self._stop_encode_loop()
+
+        leftover = self.length()
+
+        # unacknowledged operations stay in the queue log and are replayed
+        # at the next start, killing the batches in flight loses nothing
+        for dest in self._destinations.itervalues():
+            dest.push_glet.kill()
+            dest.push_pool.kill()
+            dest.pending.sync()
+
+        self.statistics['checkpoint.drain_ms'] = int((time.time() - t0) * 1000)
+        self.statistics['checkpoint.leftover'] = leftover
+        if leftover != 0:
+            LOG.info('{} - checkpoint deadline reached, {} indicators left in the queue log'.format(self.name, leftover))
+
+        LOG.debug('{} - checkpoint with {} elements in the queue'.format(self.name, leftover))
         super(Output, self).checkpoint(source=source, value=value)
 
     @_counting('update.processed')
     def filtered_update(self, source=None, indicator=None, value=None):
-        try:
-            for i in self._encode_indicator(indicator, value, expired=False):
-                self._queue.put(
-                    i,
-                    block=True,
-                    timeout=0.001
-                )
-        except Full:
-            self.statistics['error.queue_full'] += 1
+        self._enqueue(indicator, value, expired=False)
 
     @_counting('withdraw.processed')
     def filtered_withdraw(self, source=None, indicator=None, value=None):
@@ -474,15 +1730,273 @@ class Output(ActorBaseFT):
             self.statistics['error.no_value'] += 1
             return
 
+        self._enqueue(indicator, value, expired=True)
+
+    def _enqueue(self, indicator, value, expired):
+        if self._use_encoder_pool():
+            self._encode_buffer.append((indicator, value, expired))
+            self._encode_wakeup.set()
+            return
+
+        self._enqueue_inline(indicator, value, expired)
+
+    def _use_encoder_pool(self):
+        if self._encode_glet is None:
+            return False
+
+        # buffered indicators go first, the order must be kept
+        if len(self._encode_buffer) != 0:
+            return True
+
+        now = int(time.time())
+        if now != self._arrivals_second:
+            self._arrivals_second = now
+            self._arrivals = 0
+        self._arrivals += 1
+
+        return self._arrivals > self.encoder_threshold
+
+    def _encode_loop(self):
+        """Encodes the buffered indicators in the worker processes, one
+        request per worker at a time, and queues the results in order.
+        Indicators stay in the buffer until their result is queued.
+        """
+        while True:
+            self._encode_wakeup.clear()
+            if len(self._encode_buffer) == 0:
+                self._encode_wakeup.wait()
+                continue
+
+            jobs = []
+            offset = 0
+            for _ in range(self.encoder_processes):
+                items = list(itertools.islice(self._encode_buffer, offset, offset + self.encoder_batch_size))
+                if len(items) == 0:
+                    break
+                jobs.append((items, gevent.spawn(self._encode_remote, items)))
+                offset += len(items)
+
+            try:
+                for items, job in jobs:
+                    self._queue_encoded(items, job.get())
+
+            except gevent.GreenletExit:
+                raise
+
+            except Exception as e:
+                # the indicator that failed is dropped, the rest is sent again
+                LOG.exception('{} - error queueing encoded indicators - {}'.format(self.name, str(e)))
+                self.statistics['encoder.error'] += 1
+
+            finally:
+                for _, job in jobs:
+                    job.kill()
+
+    def _encode_remote(self, items):
+        t0 = time.time()
+
         try:
-            for i in self._encode_indicator(indicator, value, expired=True):
-                self._queue.put(
-                    i,
-                    block=True,
-                    timeout=0.001
-                )
-        except Full:
-            self.statistics['error.queue_full'] += 1
+            result = self._encoder_pool.encode(self._encoder_config, items)
+
+        except gevent.GreenletExit:
+            raise
+
+        except Exception as e:
+            # encoded by the node instead
+            LOG.error('{} - encoder worker error, encoding {} indicators in process - {}'.format(self.name, len(items), str(e)))
+            self.statistics['encoder.pool_error'] += 1
+            return [None] * len(items)
+
+        self._encode_pool_timing.observe(time.time() - t0)
+        self.statistics['encoder.pool_indicators'] += len(items)
+
+        return result
+
+    def _queue_encoded(self, items, results):
+        for (indicator, value, expired), result in itertools.izip(items, results):
+            self._encode_buffer.popleft()
+
+            if result is None:
+                # ranges, unsupported types and worker errors
+                try:
+                    self._enqueue_inline(indicator, value, expired)
+                except RuntimeError as e:
+                    LOG.error(str(e))
+                continue
+
+            external_id, records_hash, fragments = result
+            records = [EncodedRecord.from_fragment(f) for f in fragments]
+
+            self._enqueue_operations([
+                (external_id, records, expired, None if expired else self._priority_lane(value), records_hash)
+            ])
+
+    def _stop_encode_loop(self):
+        if self._encode_glet is not None:
+            self._encode_glet.kill()
+            self._encode_glet = None
+
+        # nothing is lost, what is left is encoded here
+        while len(self._encode_buffer) != 0:
+            indicator, value, expired = self._encode_buffer.popleft()
+            try:
+                self._enqueue_inline(indicator, value, expired)
+            except RuntimeError as e:
+                LOG.error(str(e))
+
+        if self._encoder_pool is not None:
+            self._encoder_pool.stop()
+            self._encoder_pool = None
+
+    def _enqueue_inline(self, indicator, value, expired):
+        if value['type'] == 'IPv4' and '-' in indicator:
+            self._enqueue_range(indicator, value, expired)
+            return
+
+        records = self._encode_indicator(indicator, value, expired=expired)
+        if len(records) == 0:
+            return
+
+        self._enqueue_operations([
+            (records[0]['externalId'], records, expired, self._priority_lane(value), None)
+        ])
+
+    def _enqueue_range(self, indicator, value, expired):
+        # ranges are merged and expanded by the RangeExpander, each CIDR
+        # of the expansion is a separate tiIndicator with its own externalId
+        previous = self._ranges.value(indicator)
+        reannounced = False
+
+        if expired:
+            created, deleted = self._ranges.remove(indicator)
+
+        else:
+            created, deleted = self._ranges.add(indicator, value)
+
+            # same range again, its CIDRs could carry new attributes
+            if len(created) == 0 and len(deleted) == 0:
+                created = self._ranges.cidrs(indicator)
+                reannounced = True
+
+        operations = []
+        for cidr, first, _ in deleted:
+            external_id = RANGE_EXTERNAL_ID.format(cidr)
+            records = self._encode_indicator(cidr, value, expired=True, external_id=external_id)
+            operations.append((external_id, records, True, None, None))
+
+        for cidr, first, _ in created:
+            # a CIDR of a merged interval can cover other ranges, it takes
+            # the value of the range holding its first address
+            cidr_value = value if reannounced else self._ranges.value_at(first)
+            if cidr_value is None:
+                continue
+
+            external_id = RANGE_EXTERNAL_ID.format(cidr)
+            records = self._encode_indicator(cidr, cidr_value, expired=False, external_id=external_id)
+            operations.append((external_id, records, False, self._priority_lane(cidr_value), None))
+
+        if not self._enqueue_operations(operations):
+            # the expansion goes back to what Graph was sent, the next
+            # change of the interval computes the same operations again
+            if previous is not None:
+                self._ranges.add(indicator, previous)
+            else:
+                self._ranges.remove(indicator)
+            self.statistics['range.rejected'] += 1
+            return
+
+        if self._ranges_table is not None:
+            if expired:
+                self._ranges_table.delete(indicator)
+            else:
+                self._ranges_table.put(indicator, {
+                    'value': dict((k, value[k]) for k in RANGE_VALUE_ATTRIBUTES if k in value)
+                })
+
+        self.statistics['range.cidrs_created'] += len(created)
+        self.statistics['range.cidrs_deleted'] += len(deleted)
+
+    def _enqueue_operations(self, operations):
+        """Queues the operations of an indicator, a list of (externalId,
+        records, expired, lane, content hash), for each destination. A
+        destination whose queue can't take all of them gets none, so the
+        CIDRs of a range are never partly queued. Withdraws go to their own
+        lane, updates to lane when a priority rule gave one, otherwise to
+        the new or update lane depending on the indicator being already in
+        Graph. Returns False if a destination did not take them.
+        """
+        # records are encoded and hashed once, each destination adds its
+        # own fields to the serialized records
+        operations = [
+            (external_id, records, expired, lane,
+             content_hash if expired or content_hash is not None else self._content_hash(records))
+            for external_id, records, expired, lane, content_hash in operations
+        ]
+
+        admitted = True
+        for dest in self._destinations.itervalues():
+            queued = []
+            for external_id, records, expired, lane, content_hash in operations:
+                if not expired and self._is_unchanged(dest, external_id, content_hash):
+                    self.statistics['update.unchanged'] += 1
+                    continue
+
+                if expired:
+                    dest_lane = LANE_WITHDRAW
+                elif lane is not None:
+                    dest_lane = lane
+                elif self._is_published(dest, external_id):
+                    dest_lane = LANE_UPDATE
+                else:
+                    dest_lane = LANE_NEW
+
+                queued.append((external_id, records, expired, dest_lane))
+
+            if len(queued) == 0:
+                continue
+
+            if not dest.pending.admits([(external_id, lane, expired) for external_id, _, expired, lane in queued]):
+                self.statistics['error.queue_full'] += len(queued)
+                for external_id, _, expired, _ in queued:
+                    if expired:
+                        self._drop_withdraw(dest, external_id)
+                admitted = False
+                continue
+
+            for external_id, records, expired, lane in queued:
+                try:
+                    result = dest.pending.put(
+                        external_id,
+                        dest.records(records),
+                        delete=expired,
+                        lane=lane
+                    )
+                except Full:
+                    self.statistics['error.queue_full'] += 1
+                    if expired:
+                        self._drop_withdraw(dest, external_id)
+                    admitted = False
+                    continue
+
+                if result == REPLACED:
+                    self.statistics['queue.coalesced'] += 1
+                elif result == CANCELLED:
+                    self.statistics['queue.cancelled'] += 1
+                elif result == SPILLED:
+                    self.statistics['queue.spilled'] += 1
+                elif result == EVICTED:
+                    self.statistics['queue.evicted'] += 1
+
+        self._update_backpressure()
+
+        return admitted
+
+    def _drop_withdraw(self, dest, external_id):
+        # otherwise the refresh scheduler would submit the withdrawn
+        # indicator again, it is left to expire in Graph
+        if dest.table is not None:
+            dest.table.delete(external_id)
+        self.statistics['withdraw.dropped'] += 1
 
     @_counting('checkpoint.rx')
     def checkpoint(self, source=None, value=None):
@@ -494,27 +2008,99 @@ class Output(ActorBaseFT):
         )
 
     def length(self, source=None):
-        return self._queue.qsize()
+        # waiting to be encoded, queued in memory or on disk, and in flight
+        result = len(self._encode_buffer)
+        for dest in self._destinations.itervalues():
+            result += len(dest.pending) + dest.inflight_records
+        return result
 
     def start(self):
         super(Output, self).start()
 
-        self._push_glet = gevent.spawn(self._push_loop)
+        for dest in self._destinations.itervalues():
+            self._start_destination(dest)
+        self._started = True
+
+        self._refresh_glet = gevent.spawn(self._refresh_loop)
+        if self.reconcile_interval > 0:
+            self._reconcile_loop_glet = gevent.spawn(self._reconcile_loop)
+
+        if self.encoder_processes > 0:
+            self._encoder_pool = EncoderPool(self.encoder_processes)
+            self._encoder_pool.start()
+            self._encode_glet = gevent.spawn(self._encode_loop)
 
     def stop(self):
         super(Output, self).stop()
 
-        if self._push_glet is not None:
-            self._push_glet.kill()
+        if self._refresh_glet is not None:
+            self._refresh_glet.kill()
+
+        if self._reconcile_loop_glet is not None:
+            self._reconcile_loop_glet.kill()
+
+        if self._reconcile_glet is not None:
+            self._reconcile_glet.kill()
 
         if self._checkpoint_glet is not None:
             self._checkpoint_glet.kill()
 
+        self._stop_encode_loop()
+
+        for dest in self._destinations.itervalues():
+            self._stop_destination(dest)
+            self._close_destination(dest)
+        self._started = False
+        self._tables_open = False
+
+        if self._ranges_table is not None:
+            self._ranges_table.close()
+            self._ranges_table = None
+
+    def mgmtbus_signal(self, source=None, signal=None, **kwargs):
+        if signal == 'reconcile':
+            if not self._start_reconcile():
+                return 'reconciliation already running'
+            return 'OK'
+
+        if signal == 'trace_dump':
+            return self._dump_traces(clear=kwargs.get('clear', False))
+
+        if signal == 'replay_dead_letters':
+            return '{} operations queued'.format(self._replay_dead_letters())
+
+        return super(Output, self).mgmtbus_signal(source=source, signal=signal, **kwargs)
+
+    def _dump_traces(self, clear=False):
+        """Returns the sampled traces, also written next to the side config
+        for the web UI.
+        """
+        traces = self._tracer.dump()
+        if clear:
+            self._tracer.clear()
+
+        path = os.path.join(os.path.dirname(self.side_config_path), '{}_traces.yml'.format(self.name))
+        try:
+            with open(path, 'w') as f:
+                yaml.safe_dump({'timestamp': int(time.time()), 'traces': traces}, f)
+
+        except Exception as e:
+            LOG.error('{} - error writing traces to {} - {}'.format(self.name, path, str(e)))
+
+        return traces
+
     def hup(self, source=None):
         LOG.info('%s - hup received, reload side config', self.name)
         self._load_side_config()
+        self._configure_encoder()
+        self._configure_destinations()
+        self._tracer.sample_rate = self.trace_sample_rate
 
     @staticmethod
     def gc(name, config=None):
         ActorBaseFT.gc(name, config=config)
-        shutil.rmtree(name, ignore_errors=True)
\ No newline at end of file
+        shutil.rmtree(name, ignore_errors=True)
+        shutil.rmtree('{}_queue'.format(name), ignore_errors=True)
+        shutil.rmtree('{}_deadletter'.format(name), ignore_errors=True)
+        shutil.rmtree('{}_ranges'.format(name), ignore_errors=True)
+        shutil.rmtree('{}_destinations'.format(name), ignore_errors=True)
\ No newline at end of file
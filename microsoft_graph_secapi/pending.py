@@ -0,0 +1,429 @@
+import time
+from collections import OrderedDict, defaultdict
+
+import gevent.event
+from gevent.queue import Full
+
+# Result of PendingQueue.put
+ADDED = 0
+REPLACED = 1
+CANCELLED = 2
+SPILLED = 3
+# added in memory in place of an evicted operation
+EVICTED = 4
+
+# What put does with an operation when memory is full
+OVERFLOW_SPILL = 'spill'
+OVERFLOW_DROP_NEW = 'drop_new'
+OVERFLOW_DROP_OLDEST = 'drop_oldest'
+OVERFLOW_POLICIES = frozenset([OVERFLOW_SPILL, OVERFLOW_DROP_NEW, OVERFLOW_DROP_OLDEST])
+
+# Where put places a new operation
+_MEMORY = 0
+_SPILL = 1
+_EVICT = 2
+_REJECT = 3
+
+# Lane of the operations when the queue has a single one
+DEFAULT_LANE = 'default'
+
+
+class PendingEntry(object):
+    __slots__ = ['key', 'delete', 'records', 'seq', 'attempts', 'not_before', 'queued_at', 'lane']
+
+    def __init__(self, key, delete, records, seq=None, attempts=0, not_before=None, queued_at=None,
+                 lane=DEFAULT_LANE):
+        self.key = key
+        self.delete = delete
+        self.records = records
+        self.seq = seq
+        self.attempts = attempts
+        self.not_before = not_before
+        self.queued_at = queued_at
+        self.lane = lane
+
+
+class PendingQueue(object):
+    """Pending Graph operations keyed by externalId.
+
+    Each externalId has at most one pending operation in memory, stored
+    as the list of tiIndicator records to send and a delete flag. A newer
+    operation replaces the pending one keeping its position, and a delete
+    cancels a pending submit when is_published says the indicator has
+    never been published. maxsize bounds the number of distinct
+    externalIds kept in memory.
+
+    When a SegmentLog is given every operation is written to it first and
+    acknowledged once handled. Operations that don't fit in memory stay
+    only in the log and are loaded in order as memory frees up.
+
+    overflow says what happens to a new operation when memory is full:
+    OVERFLOW_SPILL keeps it in the log, OVERFLOW_DROP_NEW rejects it and
+    OVERFLOW_DROP_OLDEST drops the oldest operation of the evict lane to
+    make room, rejecting it when that lane is empty. Operations of a key
+    already in the log are always spilled, to keep them in order, and so
+    are deletes.
+
+    Operations are put in lanes, lanes is a list of (name, weight) with
+    the lowest priority lane last, which also gets operations of unknown
+    lanes.
+    Batches take records from the lanes in proportion to their weight
+    (start-time fair queueing on the number of records), so a busy lane
+    can't hold back the others. Operations of express lanes don't wait
+    behind operations already in the log, and those of the first lane can
+    use reserve slots over maxsize.
+    """
+    def __init__(self, maxsize=None, is_published=None, log=None, log_maxsize=None,
+                 lanes=None, express=None, reserve=0, overflow=OVERFLOW_SPILL, evict=None):
+        self.maxsize = maxsize
+        self.is_published = is_published
+        self.log = log
+        self.log_maxsize = log_maxsize
+        self.express = frozenset(express or [])
+        self.reserve = reserve
+        self.overflow = overflow
+        self.evict = evict
+
+        if lanes is None:
+            lanes = [(DEFAULT_LANE, 1)]
+        self._weights = OrderedDict((name, float(weight)) for name, weight in lanes)
+        self._lanes = OrderedDict((name, OrderedDict()) for name in self._weights)
+        self._vtime = dict((name, 0.0) for name in self._weights)
+        self._first_lane = next(iter(self._weights))
+
+        self._entries = {}
+        self._num_records = 0
+        self._num_spilled = 0
+        self._spilled_keys = defaultdict(int)
+        self._spilled_since = None
+        self._wakeup = gevent.event.Event()
+
+    def __len__(self):
+        return self._num_records + self._num_spilled
+
+    def __contains__(self, key):
+        return key in self._entries or key in self._spilled_keys
+
+    def num_keys(self):
+        return len(self._entries)
+
+    def num_spilled(self):
+        return self._num_spilled
+
+    def lane_depths(self):
+        """Returns the number of operations in memory by lane"""
+        return dict((name, len(entries)) for name, entries in self._lanes.iteritems())
+
+    def oldest_age(self):
+        """Returns the number of seconds the oldest pending operation has
+        been waiting, 0 if there are none.
+        """
+        oldest = None
+
+        for entries in self._lanes.itervalues():
+            for entry in entries.itervalues():
+                if entry.queued_at is not None and (oldest is None or entry.queued_at < oldest):
+                    oldest = entry.queued_at
+                break
+
+        # operations waiting in the log are older than most of those in memory
+        if self._num_spilled != 0 and self._spilled_since is not None:
+            if oldest is None or self._spilled_since < oldest:
+                oldest = self._spilled_since
+
+        if oldest is None:
+            return 0
+        return max(time.time() - oldest, 0)
+
+    def open(self):
+        """Opens the log and schedules the replay of what was left in it."""
+        if self.log is None:
+            return
+
+        self.log.open()
+        for _, key, queued_at in self.log.scan():
+            if self._spilled_since is None:
+                self._spilled_since = queued_at if queued_at is not None else time.time()
+            self._spilled_keys[key] += 1
+            self._num_spilled += 1
+
+        if self._num_spilled != 0:
+            self._wakeup.set()
+
+    def close(self):
+        if self.log is not None:
+            self.log.close()
+
+    def sync(self):
+        if self.log is not None:
+            self.log.sync()
+
+    def admits(self, operations):
+        """Returns True if put accepts every (key, lane, delete) of
+        operations, so that the operations of an indicator can be queued
+        all or none.
+        """
+        num_entries = len(self._entries)
+        num_spilled = 0
+        evictable = 0
+        if self.evict in self._lanes:
+            evictable = len(self._lanes[self.evict])
+
+        keys = set()
+        for key, lane, delete in operations:
+            if key in keys:
+                continue
+            keys.add(key)
+            if key in self._entries and key not in self._spilled_keys:
+                continue
+
+            placement = self._placement(key, lane, num_entries, delete)
+            if placement == _MEMORY:
+                num_entries += 1
+            elif placement == _SPILL:
+                num_spilled += 1
+            elif placement == _EVICT and evictable != 0:
+                evictable -= 1
+            else:
+                return False
+
+        if num_spilled == 0:
+            return True
+        if self.log is None:
+            return False
+        return self.log_maxsize is None or len(self.log) + num_spilled <= self.log_maxsize
+
+    def put(self, key, records, delete=False, attempts=0, not_before=None, lane=DEFAULT_LANE):
+        now = time.time()
+
+        # a key with operations still on disk is spilled even if an older
+        # one is in memory, replacing it would overtake those on disk
+        placement = _MEMORY
+        if key not in self._entries or key in self._spilled_keys:
+            placement = self._placement(key, lane, len(self._entries), delete)
+
+        if placement == _REJECT:
+            raise Full()
+
+        if placement == _EVICT:
+            if not self._evict_oldest():
+                raise Full()
+
+        elif placement == _SPILL:
+            if self.log is None:
+                raise Full()
+            if self.log_maxsize is not None and len(self.log) >= self.log_maxsize:
+                raise Full()
+
+            # keep it only on disk, ahead of it there are older spilled operations
+            self.log.append(key, delete, records, now, lane, spilled=True)
+            if self._num_spilled == 0:
+                self._spilled_since = now
+            self._spilled_keys[key] += 1
+            self._num_spilled += 1
+            self._wakeup.set()
+            return SPILLED
+
+        seq = None
+        if self.log is not None:
+            seq = self.log.append(key, delete, records, now, lane)
+
+        result = self._admit(key, delete, records, seq, attempts=attempts, not_before=not_before,
+                             queued_at=now, lane=lane)
+        if placement == _EVICT:
+            return EVICTED
+        return result
+
+    def ack(self, entries):
+        if self.log is None:
+            return
+
+        for entry in entries:
+            if entry.seq is not None:
+                self.log.ack(entry.seq)
+
+    def get_batch(self, max_records, busy):
+        """Pops entries whose key is not in busy and that are not waiting
+        for a retry, up to max_records records. Each lane gives its oldest
+        entries, the lane served next is the one that got the fewest
+        records for its weight. An entry bigger than max_records is
+        returned alone. Returns a list of PendingEntry.
+        """
+        if self._num_spilled != 0:
+            self._refill()
+
+        result = []
+        num_records = 0
+        now = time.time()
+
+        heads = {}
+        for lane, entries in self._lanes.iteritems():
+            ready = self._ready(entries, busy, now)
+            entry = next(ready, None)
+            if entry is not None:
+                heads[lane] = (entry, ready)
+
+        while len(heads) != 0:
+            lane = min(heads, key=self._vtime.__getitem__)
+            entry, ready = heads[lane]
+
+            if len(result) != 0 and num_records + len(entry.records) > max_records:
+                break
+
+            result.append(entry)
+            num_records += len(entry.records)
+            self._vtime[lane] += len(entry.records) / self._weights[lane]
+            if num_records >= max_records:
+                break
+
+            entry = next(ready, None)
+            if entry is None:
+                del heads[lane]
+            else:
+                heads[lane] = (entry, ready)
+
+        for entry in result:
+            self._pop(entry)
+        self._num_records -= num_records
+
+        if len(result) == 0 and self._num_spilled == 0:
+            self._wakeup.clear()
+
+        return result
+
+    def notify(self):
+        self._wakeup.set()
+
+    def wait(self, timeout=None):
+        return self._wakeup.wait(timeout=timeout)
+
+    def _ready(self, entries, busy, now):
+        for key, entry in entries.iteritems():
+            if key in busy:
+                continue
+
+            if entry.not_before is not None and entry.not_before > now:
+                continue
+
+            yield entry
+
+    def _is_full(self, extra=0, num_entries=None):
+        if num_entries is None:
+            num_entries = len(self._entries)
+        return self.maxsize is not None and num_entries >= self.maxsize + extra
+
+    def _placement(self, key, lane, num_entries, delete=False):
+        """Returns where put places a new operation for key when num_entries
+        keys are in memory.
+        """
+        if key in self._spilled_keys:
+            return _SPILL
+
+        if lane in self.express:
+            full = self._is_full(self.reserve if lane == self._first_lane else 0, num_entries)
+            if not full:
+                return _MEMORY
+        else:
+            full = self._is_full(num_entries=num_entries)
+            if not full:
+                return _SPILL if self._num_spilled != 0 else _MEMORY
+
+        # a dropped delete would leave the indicator in Graph for good, the
+        # overflow policy only applies to creates and updates
+        if delete:
+            return _SPILL
+        if self.overflow == OVERFLOW_DROP_NEW:
+            return _REJECT
+        if self.overflow == OVERFLOW_DROP_OLDEST:
+            # evicting an operation of the same lane would only churn
+            return _EVICT if lane != self.evict else _REJECT
+        return _SPILL
+
+    def _evict_oldest(self):
+        entries = self._lanes.get(self.evict, None)
+        if not entries:
+            return False
+
+        entry = next(entries.itervalues())
+        self._pop(entry)
+        self._num_records -= len(entry.records)
+        if self.log is not None and entry.seq is not None:
+            self.log.ack(entry.seq)
+        return True
+
+    def _append(self, entry):
+        entries = self._lanes.get(entry.lane, None)
+        if entries is None:
+            # lane unknown to this queue, e.g. read back from an older log
+            entry.lane = next(reversed(self._lanes))
+            entries = self._lanes[entry.lane]
+
+        if len(entries) == 0:
+            # an idle lane doesn't bank the time it was idle
+            active = [self._vtime[l] for l, e in self._lanes.iteritems() if len(e) != 0]
+            if len(active) != 0:
+                self._vtime[entry.lane] = max(self._vtime[entry.lane], min(active))
+
+        entries[entry.key] = entry
+        self._entries[entry.key] = entry
+
+    def _pop(self, entry):
+        self._entries.pop(entry.key)
+        self._lanes[entry.lane].pop(entry.key)
+
+    def _admit(self, key, delete, records, seq, attempts=0, not_before=None, queued_at=None, lane=DEFAULT_LANE):
+        entry = self._entries.get(key, None)
+
+        if entry is None:
+            self._append(PendingEntry(key, delete, records, seq, attempts, not_before, queued_at, lane))
+            self._num_records += len(records)
+            self._wakeup.set()
+            return ADDED
+
+        self._num_records -= len(entry.records)
+        if self.log is not None and entry.seq is not None:
+            self.log.ack(entry.seq)
+
+        if delete and not entry.delete and self.is_published is not None and not self.is_published(key):
+            # nothing has been sent yet, submit and delete cancel out
+            self._pop(entry)
+            if self.log is not None and seq is not None:
+                self.log.ack(seq)
+            return CANCELLED
+
+        entry.delete = delete
+        entry.records = records
+        entry.seq = seq
+        entry.attempts = attempts
+        entry.not_before = not_before
+        if lane != entry.lane:
+            # the newer operation waits in its own lane
+            self._pop(entry)
+            entry.lane = lane
+            self._append(entry)
+        self._num_records += len(records)
+        self._wakeup.set()
+        return REPLACED
+
+    def _refill(self):
+        while self._num_spilled != 0 and not self._is_full():
+            count = 1000
+            if self.maxsize is not None:
+                count = min(count, self.maxsize - len(self._entries))
+
+            loaded = self.log.read(count)
+            if len(loaded) == 0:
+                # should never happen, log and counters are out of sync
+                self._num_spilled = 0
+                self._spilled_keys.clear()
+                break
+
+            for seq, key, delete, records, queued_at, lane in loaded:
+                self._num_spilled -= 1
+                self._spilled_keys[key] -= 1
+                if self._spilled_keys[key] <= 0:
+                    del self._spilled_keys[key]
+
+                # the next spilled operation is at least this old
+                self._spilled_since = queued_at
+                self._admit(key, delete, records, seq, queued_at=queued_at, lane=lane)
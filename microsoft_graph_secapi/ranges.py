@@ -0,0 +1,179 @@
+import bisect
+from collections import OrderedDict
+
+import netaddr
+
+# Maximum number of cached interval to CIDRs expansions
+MAX_CACHED_EXPANSIONS = 10000
+
+
+def parse_range(indicator):
+    """Returns the (first, last) integer addresses of an IPv4 range
+    written as a1-a2.
+    """
+    a1, a2 = indicator.split('-', 1)
+    first = int(netaddr.IPAddress(a1.strip()))
+    last = int(netaddr.IPAddress(a2.strip()))
+    if first > last:
+        first, last = last, first
+    return first, last
+
+
+class RangeExpander(object):
+    """Tracks the IPv4 ranges announced by the feed and their expansion to
+    CIDRs.
+
+    Overlapping and adjacent ranges are merged, and the union is expanded
+    to the minimal set of CIDRs. Adding or removing a range only
+    recomputes the merged interval it touches and returns the exact
+    difference with the CIDRs previously generated for it, so a small edit
+    costs a few Graph calls. Expansions are cached by interval.
+    """
+    def __init__(self):
+        # range -> (first, last, value)
+        self._ranges = {}
+        # sorted (first, last, range) of the announced ranges
+        self._starts = []
+        # sorted, disjoint and non adjacent [first, last] of the union
+        self._merged = []
+
+        self._cache = OrderedDict()
+
+    def __len__(self):
+        return len(self._ranges)
+
+    def __contains__(self, indicator):
+        return indicator in self._ranges
+
+    def value(self, indicator):
+        entry = self._ranges.get(indicator, None)
+        if entry is None:
+            return None
+        return entry[2]
+
+    def value_at(self, address):
+        """Returns the value of an announced range containing address."""
+        idx = self._find_merged(address)
+        if idx < 0 or self._merged[idx][1] < address:
+            return None
+        mfirst = self._merged[idx][0]
+
+        pos = bisect.bisect_right(self._starts, (address, float('inf'), '')) - 1
+        while pos >= 0 and self._starts[pos][0] >= mfirst:
+            rfirst, rlast, indicator = self._starts[pos]
+            if rlast >= address:
+                return self._ranges[indicator][2]
+            pos -= 1
+
+        return None
+
+    def cidrs(self, indicator):
+        """Returns the CIDRs currently covering the given announced range."""
+        entry = self._ranges.get(indicator, None)
+        if entry is None:
+            return []
+
+        first, last, _ = entry
+        idx = self._find_merged(first)
+        mfirst, mlast = self._merged[idx]
+        return [
+            c for c in self._expand(mfirst, mlast)
+            if c[2] >= first and c[1] <= last
+        ]
+
+    def add(self, indicator, value):
+        """Adds or updates a range. Returns (created, deleted), the lists of
+        (cidr, first, last) added to and removed from the expansion.
+        """
+        first, last = parse_range(indicator)
+
+        entry = self._ranges.get(indicator, None)
+        self._ranges[indicator] = (first, last, value)
+        if entry is not None:
+            return [], []
+
+        bisect.insort(self._starts, (first, last, indicator))
+
+        # merged intervals overlapping or adjacent to the new range
+        lo = bisect.bisect_left(self._merged, [first - 1, -1])
+        if lo > 0 and self._merged[lo - 1][1] >= first - 1:
+            lo -= 1
+        hi = lo
+        while hi < len(self._merged) and self._merged[hi][0] <= last + 1:
+            hi += 1
+
+        old = []
+        wfirst, wlast = first, last
+        for mfirst, mlast in self._merged[lo:hi]:
+            old.extend(self._expand(mfirst, mlast))
+            wfirst = min(wfirst, mfirst)
+            wlast = max(wlast, mlast)
+
+        self._merged[lo:hi] = [[wfirst, wlast]]
+
+        return self._diff(old, self._expand(wfirst, wlast))
+
+    def remove(self, indicator):
+        """Removes a range. Returns (created, deleted) like add."""
+        entry = self._ranges.pop(indicator, None)
+        if entry is None:
+            return [], []
+
+        first, last, _ = entry
+        self._starts.remove((first, last, indicator))
+
+        idx = self._find_merged(first)
+        mfirst, mlast = self._merged[idx]
+        old = self._expand(mfirst, mlast)
+
+        # a merged interval contains whole ranges, re-merge those left in it
+        remaining = []
+        pos = bisect.bisect_left(self._starts, (mfirst, -1, ''))
+        while pos < len(self._starts) and self._starts[pos][0] <= mlast:
+            rfirst, rlast, _ = self._starts[pos]
+            if len(remaining) != 0 and rfirst <= remaining[-1][1] + 1:
+                remaining[-1][1] = max(remaining[-1][1], rlast)
+            else:
+                remaining.append([rfirst, rlast])
+            pos += 1
+
+        self._merged[idx:idx + 1] = remaining
+
+        new = []
+        for rfirst, rlast in remaining:
+            new.extend(self._expand(rfirst, rlast))
+
+        return self._diff(old, new)
+
+    def _find_merged(self, address):
+        idx = bisect.bisect_right(self._merged, [address, float('inf')]) - 1
+        return idx
+
+    def _expand(self, first, last):
+        key = (first, last)
+
+        result = self._cache.get(key, None)
+        if result is not None:
+            self._cache.pop(key)
+            self._cache[key] = result
+            return result
+
+        result = [
+            (str(c), c.first, c.last)
+            for c in netaddr.IPRange(first, last).cidrs()
+        ]
+
+        self._cache[key] = result
+        if len(self._cache) > MAX_CACHED_EXPANSIONS:
+            self._cache.popitem(last=False)
+
+        return result
+
+    def _diff(self, old, new):
+        old_set = set(c[0] for c in old)
+        new_set = set(c[0] for c in new)
+
+        created = [c for c in new if c[0] not in old_set]
+        deleted = [c for c in old if c[0] not in new_set]
+
+        return created, deleted
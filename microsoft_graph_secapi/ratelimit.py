@@ -0,0 +1,97 @@
+import calendar
+import random
+import time
+from email.utils import parsedate_tz, mktime_tz
+
+import gevent
+
+
+def parse_retry_after(value):
+    """Returns the number of seconds in a Retry-After header value,
+    given either as delta-seconds or as an HTTP date. None if invalid.
+    """
+    if value is None:
+        return None
+
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+
+    parsed = parsedate_tz(value)
+    if parsed is None:
+        return None
+
+    return max(mktime_tz(parsed) - calendar.timegm(time.gmtime()), 0)
+
+
+class RateController(object):
+    """Paces the requests sent to Graph and sizes the batches.
+
+    Requests are paced by a token bucket of rate requests per second with
+    burst capacity. A throttling answer pauses every sender until its
+    Retry-After expires. The batch size grows by one after each batch
+    answered faster than target_latency, and is halved when a batch is
+    slow, throttled or fails.
+    """
+    def __init__(self, rate, burst, max_batch_size, min_batch_size=1,
+                 target_latency=10.0, backoff_base=2.0, backoff_max=120.0):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.max_batch_size = max_batch_size
+        self.min_batch_size = min_batch_size
+        self.target_latency = target_latency
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        self.batch_size = max_batch_size
+
+        self._tokens = self.burst
+        self._last = time.time()
+        self._paused_until = 0
+
+    def acquire(self):
+        """Blocks the calling greenlet until a request can be sent.
+        Returns the time spent waiting.
+        """
+        t0 = time.time()
+
+        while True:
+            now = time.time()
+            if now < self._paused_until:
+                gevent.sleep(self._paused_until - now)
+                continue
+
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return time.time() - t0
+
+            gevent.sleep((1 - self._tokens) / self.rate)
+
+    def backoff(self, attempt):
+        """Exponential backoff with jitter for the given attempt (1-based)"""
+        delay = min(self.backoff_max, self.backoff_base * (2 ** (attempt - 1)))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def on_success(self, latency):
+        if latency > self.target_latency:
+            self._decrease()
+        elif self.batch_size < self.max_batch_size:
+            self.batch_size += 1
+
+    def on_error(self):
+        self._decrease()
+
+    def on_throttle(self, retry_after=None, attempt=1):
+        self._decrease()
+
+        if retry_after is None:
+            retry_after = self.backoff(attempt)
+
+        self._paused_until = max(self._paused_until, time.time() + retry_after)
+
+        return retry_after
+
+    def _decrease(self):
+        self.batch_size = max(self.min_batch_size, self.batch_size // 2)
@@ -0,0 +1,75 @@
+import array
+import bisect
+import hashlib
+import heapq
+import struct
+
+# array typecode of a native unsigned long, 8 bytes on 64-bit Linux
+HASH_TYPECODE = 'L'
+# Hashes are sorted in runs of this size and merged when the set is frozen
+RUN_SIZE = 65536
+
+
+class ExternalIdSet(object):
+    """Compact set of externalIds used by the reconciliation.
+
+    Only a fixed size hash of each externalId is kept, packed in an
+    array, so a few million ids cost a few MB instead of a Python set of
+    strings. Ids are added while paging through Graph, then the set is
+    frozen (sorted run by run, then merged) and membership is tested by
+    bisection. A hash collision makes an id look present, the worst
+    outcome is a missing indicator not re-submitted until the next run.
+    """
+    def __init__(self):
+        self._runs = []
+        self._hashes = array.array(HASH_TYPECODE)
+        self._size = self._hashes.itemsize
+        self._frozen = False
+
+    def __len__(self):
+        return sum(len(r) for r in self._runs) + len(self._hashes)
+
+    def add(self, external_id):
+        if self._frozen:
+            raise RuntimeError('ExternalIdSet is frozen')
+
+        self._hashes.append(self._hash(external_id))
+        if len(self._hashes) >= RUN_SIZE:
+            self._close_run()
+
+    def freeze(self):
+        if self._frozen:
+            return
+
+        self._close_run()
+
+        merged = array.array(HASH_TYPECODE)
+        for h in heapq.merge(*self._runs):
+            merged.append(h)
+
+        self._runs = []
+        self._hashes = merged
+        self._frozen = True
+
+    def __contains__(self, external_id):
+        if not self._frozen:
+            raise RuntimeError('ExternalIdSet is not frozen')
+
+        h = self._hash(external_id)
+        idx = bisect.bisect_left(self._hashes, h)
+        return idx < len(self._hashes) and self._hashes[idx] == h
+
+    def _close_run(self):
+        # array has no sort, only a run at a time goes through a list
+        if len(self._hashes) != 0:
+            self._runs.append(array.array(HASH_TYPECODE, sorted(self._hashes)))
+        self._hashes = array.array(HASH_TYPECODE)
+
+    def _hash(self, external_id):
+        if isinstance(external_id, unicode):
+            external_id = external_id.encode('utf8')
+
+        digest = hashlib.md5(external_id).digest()
+        if self._size == 8:
+            return struct.unpack('<Q', digest[:8])[0]
+        return struct.unpack('<I', digest[:4])[0]
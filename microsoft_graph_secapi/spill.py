@@ -0,0 +1,298 @@
+import logging
+import os
+import shutil
+from collections import deque
+
+import ujson as json
+
+from .encoder import EncodedRecord, fragment
+
+LOG = logging.getLogger(__name__)
+
+SEGMENT_SUFFIX = '.seg'
+ACK_SUFFIX = '.ack'
+
+
+class _Segment(object):
+    __slots__ = ['first_seq', 'path', 'num_entries', 'acked']
+
+    def __init__(self, first_seq, path):
+        self.first_seq = first_seq
+        self.path = path
+        self.num_entries = 0
+        self.acked = set()
+
+
+class SegmentLog(object):
+    """Append-only log of pending operations, split in segment files.
+
+    Each operation is written as a JSON line [seq, key, delete, records,
+    queued_at, lane] to the active segment, built from the serialized fragments
+    of the records. Acknowledged sequence numbers are appended to
+    a companion .ack file, and a segment is removed as soon as all its
+    entries have been acknowledged.
+
+    Only the entries appended with spilled set, and those left
+    unacknowledged when the log is opened, are read back: the others are
+    also held in memory by the caller. They are read in order from a
+    cursor, which starts at the oldest unacknowledged entry when the log is
+    opened, and kept as runs of consecutive sequence numbers.
+    """
+    def __init__(self, path, segment_size=10000):
+        self.path = path
+        self.segment_size = segment_size
+
+        self._segments = []
+        self._next_seq = 0
+        self._num_unacked = 0
+
+        self._writer = None
+        self._ack_writer = None
+
+        self._cursor_segment = 0
+        self._cursor_offset = 0
+        self._unread = deque()
+
+    def __len__(self):
+        return self._num_unacked
+
+    def open(self, truncate=False):
+        if truncate:
+            shutil.rmtree(self.path, ignore_errors=True)
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+        self._segments = []
+        self._num_unacked = 0
+        self._unread = deque()
+
+        names = [n for n in os.listdir(self.path) if n.endswith(SEGMENT_SUFFIX)]
+        for first_seq in sorted(int(n[:-len(SEGMENT_SUFFIX)]) for n in names):
+            segment = _Segment(first_seq, self._segment_path(first_seq))
+
+            last_seq = first_seq - 1
+            with open(segment.path, 'rb') as f:
+                for line in f:
+                    # a truncated last line is what a crash mid-write leaves behind
+                    if not line.endswith('\n'):
+                        break
+                    segment.num_entries += 1
+                    last_seq = first_seq + segment.num_entries - 1
+
+            ack_path = self._ack_path(segment)
+            if os.path.exists(ack_path):
+                with open(ack_path, 'rb') as f:
+                    for line in f:
+                        if line.endswith('\n'):
+                            segment.acked.add(int(line))
+
+            self._segments.append(segment)
+            self._num_unacked += segment.num_entries - len(segment.acked)
+            self._next_seq = last_seq + 1
+
+            # whatever is left is no longer in memory and must be read back
+            for seq in range(first_seq, first_seq + segment.num_entries):
+                if seq not in segment.acked:
+                    self._add_unread(seq)
+
+            if len(segment.acked) == segment.num_entries:
+                self._remove_segment(len(self._segments) - 1)
+
+        self._cursor_segment = 0
+        self._cursor_offset = 0
+
+        # always append to a fresh segment, the last one could end with a partial line
+        self._writer = None
+        self._ack_writer = None
+
+        LOG.info('%s - opened with %d unacknowledged entries', self.path, self._num_unacked)
+
+    def close(self):
+        for w in [self._writer, self._ack_writer]:
+            if w is not None:
+                w.flush()
+                os.fsync(w.fileno())
+                w.close()
+        self._writer = None
+        self._ack_writer = None
+
+    def sync(self):
+        for w in [self._writer, self._ack_writer]:
+            if w is not None:
+                w.flush()
+                os.fsync(w.fileno())
+
+    def append(self, key, delete, records, queued_at, lane=None, spilled=False):
+        """Appends an operation and returns its sequence number. Entries
+        appended with spilled set are returned by read.
+        """
+        if self._writer is None or self._segments[-1].num_entries >= self.segment_size:
+            self._rotate()
+
+        seq = self._next_seq
+        self._next_seq += 1
+
+        self._writer.write('[{},{},{},[{}],{!r},{}]\n'.format(
+            seq,
+            json.dumps(key),
+            'true' if delete else 'false',
+            ','.join(fragment(r) for r in records),
+            queued_at,
+            json.dumps(lane)
+        ))
+        self._writer.flush()
+
+        self._segments[-1].num_entries += 1
+        self._num_unacked += 1
+        if spilled:
+            self._add_unread(seq)
+
+        return seq
+
+    def ack(self, seq):
+        idx = self._find_segment(seq)
+        if idx is None:
+            return
+
+        segment = self._segments[idx]
+        if seq in segment.acked:
+            return
+
+        segment.acked.add(seq)
+        self._num_unacked -= 1
+
+        ack_path = self._ack_path(segment)
+        if self._ack_writer is None or self._ack_writer.name != ack_path:
+            if self._ack_writer is not None:
+                self._ack_writer.close()
+            self._ack_writer = open(ack_path, 'ab')
+
+        self._ack_writer.write('{}\n'.format(seq))
+        self._ack_writer.flush()
+
+        if len(segment.acked) == segment.num_entries and idx != len(self._segments) - 1:
+            self._remove_segment(idx)
+
+    def scan(self):
+        """Yields (seq, key, queued_at) of every unacknowledged entry,
+        without moving the read cursor.
+        """
+        for segment in list(self._segments):
+            with open(segment.path, 'rb') as f:
+                for line in f:
+                    if not line.endswith('\n'):
+                        break
+
+                    entry = json.loads(line)
+                    if entry[0] in segment.acked:
+                        continue
+                    # entries written before queued_at was logged count as new
+                    yield entry[0], entry[1], entry[4] if len(entry) > 4 else None
+
+    def num_unread(self):
+        return sum(last - first + 1 for first, last in self._unread)
+
+    def read(self, max_entries):
+        """Returns up to max_entries unacknowledged spilled entries after
+        the cursor, as (seq, key, delete, records, queued_at, lane) tuples,
+        and advances the cursor.
+        """
+        result = []
+
+        while len(result) < max_entries and len(self._unread) != 0 and \
+                self._cursor_segment < len(self._segments):
+            segment = self._segments[self._cursor_segment]
+
+            with open(segment.path, 'rb') as f:
+                f.seek(self._cursor_offset)
+                while len(result) < max_entries and len(self._unread) != 0:
+                    line = f.readline()
+                    if not line.endswith('\n'):
+                        break
+                    self._cursor_offset += len(line)
+
+                    # entries held in memory are skipped without decoding them
+                    seq = int(line[1:line.index(',')])
+                    self._skip_unread(seq)
+                    if len(self._unread) == 0 or self._unread[0][0] != seq:
+                        continue
+                    self._skip_unread(seq + 1)
+                    if seq in segment.acked:
+                        continue
+
+                    entry = json.loads(line)
+                    key, delete, records = entry[1:4]
+                    queued_at = entry[4] if len(entry) > 4 else None
+                    lane = entry[5] if len(entry) > 5 else None
+                    result.append((seq, key, delete, [EncodedRecord(r) for r in records], queued_at, lane))
+
+            if len(result) < max_entries:
+                if self._cursor_segment == len(self._segments) - 1:
+                    break
+                self._cursor_segment += 1
+                self._cursor_offset = 0
+
+        return result
+
+    def _add_unread(self, seq):
+        if len(self._unread) != 0 and self._unread[-1][1] == seq - 1:
+            self._unread[-1][1] = seq
+        else:
+            self._unread.append([seq, seq])
+
+    def _skip_unread(self, seq):
+        # drops the unread sequence numbers before seq
+        while len(self._unread) != 0 and self._unread[0][0] < seq:
+            run = self._unread[0]
+            if run[1] < seq:
+                self._unread.popleft()
+            else:
+                run[0] = seq
+
+    def _segment_path(self, first_seq):
+        return os.path.join(self.path, '{:020d}{}'.format(first_seq, SEGMENT_SUFFIX))
+
+    def _ack_path(self, segment):
+        return segment.path[:-len(SEGMENT_SUFFIX)] + ACK_SUFFIX
+
+    def _rotate(self):
+        if self._writer is not None:
+            self._writer.close()
+
+        segment = _Segment(self._next_seq, self._segment_path(self._next_seq))
+        self._segments.append(segment)
+        self._writer = open(segment.path, 'ab')
+
+        # previous segment could be already fully acknowledged
+        if len(self._segments) > 1:
+            previous = self._segments[-2]
+            if len(previous.acked) == previous.num_entries:
+                self._remove_segment(len(self._segments) - 2)
+
+    def _find_segment(self, seq):
+        for idx in range(len(self._segments) - 1, -1, -1):
+            segment = self._segments[idx]
+            if seq >= segment.first_seq:
+                if seq < segment.first_seq + segment.num_entries:
+                    return idx
+                return None
+        return None
+
+    def _remove_segment(self, idx):
+        segment = self._segments.pop(idx)
+
+        ack_path = self._ack_path(segment)
+        if self._ack_writer is not None and self._ack_writer.name == ack_path:
+            self._ack_writer.close()
+            self._ack_writer = None
+
+        for p in [segment.path, ack_path]:
+            try:
+                os.remove(p)
+            except OSError:
+                pass
+
+        if idx < self._cursor_segment:
+            self._cursor_segment -= 1
+        elif idx == self._cursor_segment:
+            self._cursor_offset = 0
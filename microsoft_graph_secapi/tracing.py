@@ -0,0 +1,69 @@
+import random
+import time
+from collections import deque
+
+# Number of traces kept by default
+TRACE_BUFFER_SIZE = 200
+
+
+class Trace(object):
+    """Events of a sampled operation, times are seconds since its start"""
+    __slots__ = ['id', 'name', 'start', 'fields', 'events']
+
+    def __init__(self, id_, name, fields):
+        self.id = id_
+        self.name = name
+        self.start = time.time()
+        self.fields = fields
+        self.events = []
+
+    def event(self, name, **fields):
+        self.events.append((time.time() - self.start, name, fields))
+
+    def to_dict(self):
+        events = []
+        for offset, name, fields in self.events:
+            event = dict(fields)
+            event['event'] = name
+            event['ms'] = int(offset * 1000)
+            events.append(event)
+
+        result = dict(self.fields)
+        result['id'] = self.id
+        result['name'] = self.name
+        result['start'] = int(self.start * 1000)
+        result['events'] = events
+        return result
+
+
+class Tracer(object):
+    """Samples operations and keeps the traces of the last ones.
+
+    start returns a Trace for a sample_rate fraction of the calls and None
+    for the others. Callers record events only when they got a Trace, so
+    with sampling disabled tracing costs a comparison per operation and
+    nothing is formatted. Finished traces go to a ring buffer of the last
+    size traces, read with dump.
+    """
+    def __init__(self, sample_rate=0.0, size=TRACE_BUFFER_SIZE):
+        self.sample_rate = sample_rate
+
+        self._traces = deque(maxlen=size)
+        self._next_id = 0
+
+    def start(self, name, **fields):
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            return None
+
+        self._next_id += 1
+        return Trace(self._next_id, name, fields)
+
+    def finish(self, trace, **fields):
+        trace.event('end', **fields)
+        self._traces.append(trace)
+
+    def dump(self):
+        return [t.to_dict() for t in self._traces]
+
+    def clear(self):
+        self._traces.clear()
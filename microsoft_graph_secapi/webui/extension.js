@@ -341,12 +341,203 @@ function MSFTISGRecommendedActionController($modalInstance) {
     }
 }
 
+function MSFTISGMetricsController($scope) {
+    var vm = this;
+
+    // histograms kept by the node as <prefix>.le_<bound>, <prefix>.count and <prefix>.sum_us
+    var TIMINGS = [
+        ['timing.token', 'TOKEN'],
+        ['timing.encode', 'ENCODE'],
+        ['timing.submit', 'SUBMIT'],
+        ['timing.delete', 'DELETE'],
+        ['timing.batch', 'JSON BATCH'],
+        ['timing.rate_wait', 'RATE WAIT'],
+        ['timing.backoff', 'BACKOFF'],
+        ['lane.withdraw.latency', 'WITHDRAW LANE'],
+        ['lane.new.latency', 'NEW LANE'],
+        ['lane.update.latency', 'UPDATE LANE'],
+        ['lane.refresh.latency', 'REFRESH LANE']
+    ];
+
+    vm.timings = [];
+    vm.batchSize = undefined;
+    vm.queue = undefined;
+
+    var parseBound = function(label) {
+        if (label === 'inf') {
+            return Infinity;
+        }
+
+        var m = /^([0-9.]+)(us|ms|s)?$/.exec(label);
+        if (!m) {
+            return undefined;
+        }
+
+        var value = parseFloat(m[1]);
+        if (m[2] === 'us') {
+            return value / 1000000;
+        }
+        if (m[2] === 'ms') {
+            return value / 1000;
+        }
+        return value;
+    };
+
+    var formatDuration = function(seconds) {
+        if (seconds === undefined || isNaN(seconds)) {
+            return '-';
+        }
+        if (seconds === Infinity) {
+            return 'inf';
+        }
+        if (seconds < 0.001) {
+            return (seconds * 1000000).toFixed(0) + 'us';
+        }
+        if (seconds < 1) {
+            return (seconds * 1000).toFixed(1) + 'ms';
+        }
+        return seconds.toFixed(2) + 's';
+    };
+
+    var histogram = function(statistics, prefix) {
+        var count = statistics[prefix + '.count'];
+        if (!count) {
+            return undefined;
+        }
+
+        var buckets = [];
+        Object.keys(statistics).forEach((key) => {
+            if (key.indexOf(prefix + '.le_') !== 0) {
+                return;
+            }
+
+            var bound = parseBound(key.slice(prefix.length + 4));
+            if (bound !== undefined) {
+                buckets.push({ bound: bound, count: statistics[key] });
+            }
+        });
+        buckets.sort((a, b) => a.bound - b.bound);
+
+        // percentiles are reported as the upper bound of their bucket
+        var percentile = function(p) {
+            var cumulative = 0;
+            for (var j = 0; j < buckets.length; j++) {
+                cumulative += buckets[j].count;
+                if (cumulative >= p * count) {
+                    return buckets[j].bound;
+                }
+            }
+            return undefined;
+        };
+
+        return {
+            count: count,
+            sum: statistics[prefix + '.sum_us'] !== undefined ? statistics[prefix + '.sum_us'] / 1000000 : statistics[prefix + '.sum'],
+            p50: percentile(0.5),
+            p95: percentile(0.95),
+            p99: percentile(0.99)
+        };
+    };
+
+    vm.formatDuration = formatDuration;
+
+    vm.update = function(statistics) {
+        if (!statistics) {
+            vm.timings = [];
+            vm.batchSize = undefined;
+            vm.queue = undefined;
+            return;
+        }
+
+        vm.timings = [];
+        TIMINGS.forEach((t) => {
+            var h = histogram(statistics, t[0]);
+            if (h) {
+                h.name = t[1];
+                h.mean = h.sum / h.count;
+                vm.timings.push(h);
+            }
+        });
+
+        vm.batchSize = histogram(statistics, 'batch.size');
+        if (vm.batchSize) {
+            vm.batchSize.mean = vm.batchSize.sum / vm.batchSize.count;
+        }
+
+        vm.queue = {
+            in_memory: statistics['queue.in_memory'] || 0,
+            on_disk: statistics['queue.on_disk'] || 0,
+            oldest_age: statistics['queue.oldest_age'] || 0,
+            target_batch_size: statistics['batch.target_size'],
+            retries: statistics['request.retries'] || 0,
+            throttled: statistics['error.throttled'] || 0,
+            backpressure: statistics['queue.backpressure'] === 1,
+            dropped: statistics['error.queue_full'] || 0,
+            evicted: statistics['queue.evicted'] || 0
+        };
+    };
+
+    $scope.$watch(() => {
+        var nodeState = $scope.$parent.vm.nodeState;
+        return nodeState ? nodeState.statistics : undefined;
+    }, vm.update, true);
+}
+
+function MSFTISGTracesController($scope, MinemeldConfigService, toastr) {
+    var vm = this;
+
+    // written by the node on the trace_dump signal
+    vm.timestamp = undefined;
+    vm.traces = [];
+
+    vm.formatEvent = function(event) {
+        var fields = [];
+
+        Object.keys(event).sort().forEach((k) => {
+            if (k === 'event' || k === 'ms') {
+                return;
+            }
+            fields.push(k + '=' + angular.toJson(event[k]));
+        });
+
+        return event.event + (fields.length ? ' ' + fields.join(' ') : '');
+    };
+
+    vm.loadTraces = function() {
+        var nodename = $scope.$parent.vm.nodename;
+
+        MinemeldConfigService.getDataFile(nodename + '_traces')
+        .then((result) => {
+            if (!result) {
+                vm.timestamp = undefined;
+                vm.traces = [];
+                return;
+            }
+
+            vm.timestamp = result.timestamp;
+            vm.traces = (result.traces || []).slice().reverse();
+        }, (error) => {
+            toastr.error('ERROR LOADING TRACES: ' + error.statusText);
+        });
+    };
+
+    vm.loadTraces();
+}
+
 angular.module('microsoftGSAWebui', [])
     .controller('MSFTISGSideConfigController', [
         '$scope', 'MinemeldConfigService', 'MineMeldRunningConfigStatusService',
         'toastr', '$modal', 'ConfirmService', '$timeout',
         MSFTISGSideConfigController
     ])
+    .controller('MSFTISGMetricsController', [
+        '$scope',
+        MSFTISGMetricsController
+    ])
+    .controller('MSFTISGTracesController', [
+        '$scope', 'MinemeldConfigService', 'toastr',
+        MSFTISGTracesController
+    ])
     .config(['$stateProvider', function($stateProvider) {
         $stateProvider.state('nodedetail.msftisgoutputinfo', {
             templateUrl: '/extensions/webui/microsoftGSAWebui/isg.output.info.html',
@@ -0,0 +1,206 @@
+import cPickle as pickle
+import logging
+import multiprocessing
+import os
+import signal
+import struct
+
+import gevent.os
+import gevent.queue
+
+from .encoder import IndicatorEncoder, content_hash, fragment
+
+LOG = logging.getLogger(__name__)
+
+_HEADER = struct.Struct('!I')
+
+
+def _encode_item(encoder, hash_exclude, item):
+    indicator, value, expired = item
+
+    # ranges depend on the range expander of the node
+    if value['type'] == 'IPv4' and '-' in indicator:
+        return None
+
+    records = encoder.encode(indicator, value, expired=expired)
+    if records is None or len(records) == 0:
+        return None
+
+    return (
+        records[0]['externalId'],
+        None if expired else content_hash(records, hash_exclude),
+        [fragment(r) for r in records]
+    )
+
+
+def _read_exactly(read, fd, size):
+    chunks = []
+    while size > 0:
+        chunk = read(fd, size)
+        if chunk == '':
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+
+def _read_message(read, fd):
+    header = _read_exactly(read, fd, _HEADER.size)
+    if header is None:
+        return None
+
+    data = _read_exactly(read, fd, _HEADER.unpack(header)[0])
+    if data is None:
+        return None
+
+    return pickle.loads(data)
+
+
+def _write_message(write, fd, message):
+    data = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+    data = _HEADER.pack(len(data)) + data
+    while len(data) != 0:
+        data = data[write(fd, data):]
+
+
+def _worker_main(request_fd, response_fd, close_fds):
+    # signals are for the node, workers exit when their pipe is closed
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    for fd in close_fds:
+        os.close(fd)
+
+    config = None
+    encoder = None
+    hash_exclude = ()
+
+    while True:
+        request = _read_message(os.read, request_fd)
+        if request is None:
+            return
+
+        request_config, items = request
+        if request_config != config:
+            config = request_config
+            encoder = IndicatorEncoder(**config['encoder'])
+            hash_exclude = config['hash_exclude']
+
+        _write_message(os.write, response_fd, [_encode_item(encoder, hash_exclude, i) for i in items])
+
+
+class _Worker(object):
+    def __init__(self):
+        self.process = None
+        self.request_fd = None
+        self.response_fd = None
+
+    def start(self, close_fds):
+        request_r, request_w = os.pipe()
+        response_r, response_w = os.pipe()
+
+        self.process = multiprocessing.Process(
+            target=_worker_main,
+            args=(request_r, response_w, close_fds + [request_w, response_r])
+        )
+        self.process.daemon = True
+        self.process.start()
+
+        os.close(request_r)
+        os.close(response_w)
+
+        gevent.os.make_nonblocking(request_w)
+        gevent.os.make_nonblocking(response_r)
+        self.request_fd = request_w
+        self.response_fd = response_r
+
+    def fds(self):
+        return [self.request_fd, self.response_fd]
+
+    def call(self, request):
+        _write_message(gevent.os.nb_write, self.request_fd, request)
+
+        result = _read_message(gevent.os.nb_read, self.response_fd)
+        if result is None:
+            raise EOFError('encoder worker {} exited'.format(self.process.pid))
+
+        return result
+
+    def stop(self):
+        # the worker exits at the end of its pipe
+        for fd in self.fds():
+            if fd is not None:
+                os.close(fd)
+        self.request_fd = None
+        self.response_fd = None
+
+        if self.process is not None and self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        self.process = None
+
+
+class EncoderPool(object):
+    """Pool of worker processes encoding indicators for the Output node.
+
+    encode sends a list of (indicator, value, expired) to an idle worker
+    and returns, for each of them, (externalId, content hash, serialized
+    records) or None when the indicator must be encoded by the node, as
+    IPv4 ranges and unsupported types are. The node side of the worker
+    pipes is non-blocking and read through gevent, so waiting for a worker
+    never blocks the hub. A worker that fails is replaced and the error
+    raised to the caller.
+    """
+    def __init__(self, processes):
+        self.processes = processes
+
+        self._workers = []
+        self._idle = gevent.queue.Queue()
+
+    def start(self):
+        for _ in range(self.processes):
+            self._idle.put(self._start_worker())
+
+    def stop(self):
+        for worker in self._workers:
+            worker.stop()
+        self._workers = []
+        self._idle = gevent.queue.Queue()
+
+    def encode(self, config, items):
+        worker = self._idle.get()
+
+        try:
+            result = worker.call((config, items))
+
+        except gevent.GreenletExit:
+            # a killed call leaves a reply in the pipe, don't reuse it
+            worker = self._replace(worker)
+            raise
+
+        except Exception:
+            worker = self._replace(worker)
+            raise
+
+        finally:
+            if worker in self._workers:
+                self._idle.put(worker)
+
+        return result
+
+    def _start_worker(self):
+        close_fds = []
+        for worker in self._workers:
+            close_fds.extend(worker.fds())
+
+        worker = _Worker()
+        worker.start(close_fds)
+        self._workers.append(worker)
+
+        return worker
+
+    def _replace(self, worker):
+        LOG.info('restarting encoder worker {}'.format(worker.process.pid))
+
+        self._workers.remove(worker)
+        worker.stop()
+
+        return self._start_worker()
@@ -0,0 +1,184 @@
+import shutil
+import tempfile
+import unittest
+
+from gevent.queue import Full
+
+from microsoft_graph_secapi.pending import PendingQueue, ADDED, REPLACED, CANCELLED, SPILLED, EVICTED, \
+    OVERFLOW_DROP_NEW, OVERFLOW_DROP_OLDEST
+from microsoft_graph_secapi.spill import SegmentLog
+
+
+def _records(key):
+    return [{'externalId': key}]
+
+
+class TestPendingQueue(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.queues = []
+
+    def tearDown(self):
+        for q in self.queues:
+            q.close()
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def _queue(self, **kwargs):
+        kwargs.setdefault('log', SegmentLog(self.path, segment_size=4))
+        q = PendingQueue(**kwargs)
+        q.open()
+        self.queues.append(q)
+        return q
+
+    def _put(self, q, key, **kwargs):
+        return q.put(key, _records(key), **kwargs)
+
+    def _drain(self, q, batch_size=2):
+        sent = []
+        while True:
+            batch = q.get_batch(batch_size, busy=set())
+            if len(batch) == 0:
+                return sent
+            sent.extend(e.key for e in batch)
+            q.ack(batch)
+
+    def test_coalesce_and_cancel(self):
+        q = self._queue(is_published=lambda key: False)
+
+        self.assertEqual(self._put(q, 'a'), ADDED)
+        self.assertEqual(self._put(q, 'a'), REPLACED)
+        self.assertEqual(self._put(q, 'a', delete=True), CANCELLED)
+        self.assertEqual(len(q), 0)
+        self.assertEqual(len(q.log), 0)
+
+    def test_spill_with_batches_in_flight(self):
+        q = self._queue(maxsize=2)
+
+        results = [self._put(q, k) for k in ['a', 'b', 'c', 'd', 'e', 'f']]
+        self.assertEqual(results, [ADDED, ADDED, SPILLED, SPILLED, SPILLED, SPILLED])
+
+        first = q.get_batch(1, busy=set())
+        second = q.get_batch(1, busy=set(['a']))
+        self.assertEqual([e.key for e in first + second], ['a', 'b'])
+
+        # memory is free again, the spilled operations are loaded in order
+        sent = []
+        third = q.get_batch(2, busy=set(['a', 'b']))
+        sent.extend(e.key for e in third)
+        q.ack(first)
+        q.ack(second)
+        q.ack(third)
+        sent.extend(self._drain(q))
+
+        self.assertEqual(sent, ['c', 'd', 'e', 'f'])
+        self.assertEqual(len(q), 0)
+        self.assertEqual(q.num_spilled(), 0)
+        self.assertFalse('e' in q or 'f' in q)
+        self.assertEqual(len(q.log), 0)
+
+    def test_spilled_key_keeps_its_order(self):
+        q = self._queue(maxsize=1)
+
+        self._put(q, 'a')
+        self.assertEqual(self._put(q, 'b'), SPILLED)
+        self.assertEqual(q.put('b', _records('b2')), SPILLED)
+
+        batches = []
+        while True:
+            batch = q.get_batch(10, busy=set())
+            if len(batch) == 0:
+                break
+            batches.append([(e.key, e.records) for e in batch])
+            q.ack(batch)
+
+        self.assertEqual(batches, [[('a', _records('a'))], [('b', _records('b'))], [('b', _records('b2'))]])
+        self.assertEqual(len(q.log), 0)
+
+    def test_refilled_key_does_not_overtake_spilled(self):
+        q = self._queue(maxsize=2)
+        self._put(q, 'a')
+        self._put(q, 'b')
+        self.assertEqual(q.put('k', _records('v1')), SPILLED)
+        self.assertEqual(q.put('k', _records('v2')), SPILLED)
+
+        # v1 is loaded back, v2 is still on disk
+        q.ack(q.get_batch(1, busy=set()))
+        q.ack(q.get_batch(1, busy=set(['k'])))
+        self.assertEqual(q.num_spilled(), 1)
+
+        self.assertEqual(q.put('k', _records('v3')), SPILLED)
+        self.assertTrue(q.admits([('k', 'default', False)]))
+
+        batches = []
+        while True:
+            batch = q.get_batch(10, busy=set())
+            if len(batch) == 0:
+                break
+            batches.append([(e.key, e.records) for e in batch])
+            q.ack(batch)
+
+        self.assertEqual(batches, [[('k', _records('v3'))]])
+        self.assertEqual(len(q.log), 0)
+
+    def test_reopen_replays_unacked(self):
+        q = self._queue(maxsize=2)
+        for k in ['a', 'b', 'c', 'd']:
+            self._put(q, k)
+        batch = q.get_batch(1, busy=set())
+        q.ack(batch)
+        in_flight = q.get_batch(1, busy=set())
+        self.assertEqual([e.key for e in in_flight], ['b'])
+        q.close()
+        self.queues.remove(q)
+
+        q = self._queue(maxsize=2)
+        self.assertEqual(len(q), 3)
+        self.assertEqual(self._drain(q), ['b', 'c', 'd'])
+        self.assertEqual(len(q.log), 0)
+
+    def test_lanes_are_weighted(self):
+        q = self._queue(lanes=[('withdraw', 3), ('refresh', 1)])
+        for i in range(8):
+            self._put(q, 'r{}'.format(i), lane='refresh')
+        for i in range(8):
+            self._put(q, 'w{}'.format(i), lane='withdraw', delete=True)
+
+        batch = q.get_batch(8, busy=set())
+        lanes = [e.lane for e in batch]
+        self.assertEqual(lanes.count('withdraw'), 6)
+        self.assertEqual(lanes.count('refresh'), 2)
+
+    def test_overflow_drop_new(self):
+        q = self._queue(maxsize=2, overflow=OVERFLOW_DROP_NEW)
+        self._put(q, 'a')
+        self._put(q, 'b')
+
+        self.assertRaises(Full, self._put, q, 'c')
+        self.assertEqual(self._put(q, 'a'), REPLACED)
+        self.assertFalse(q.admits([('c', 'default', False)]))
+        self.assertTrue(q.admits([('a', 'default', False)]))
+
+        # a withdraw is never dropped
+        self.assertTrue(q.admits([('c', 'default', True)]))
+        self.assertEqual(self._put(q, 'c', delete=True), SPILLED)
+        self.assertEqual(self._drain(q), ['a', 'b', 'c'])
+
+    def test_overflow_drop_oldest(self):
+        q = self._queue(maxsize=2, overflow=OVERFLOW_DROP_OLDEST, evict='refresh',
+                        lanes=[('new', 1), ('refresh', 1)])
+        self._put(q, 'r1', lane='refresh')
+        self._put(q, 'r2', lane='refresh')
+
+        self.assertTrue(q.admits([('n1', 'new', False), ('n2', 'new', False)]))
+        self.assertFalse(q.admits([('n1', 'new', False), ('n2', 'new', False), ('n3', 'new', False)]))
+        self.assertEqual(self._put(q, 'n1', lane='new'), EVICTED)
+        self.assertRaises(Full, self._put, q, 'r3', lane='refresh')
+        self.assertFalse('r1' in q)
+        self.assertEqual(len(q.log), 2)
+
+        self.assertEqual(self._put(q, 'w1', lane='new', delete=True), SPILLED)
+        self.assertEqual(len(q.log), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+import shutil
+import tempfile
+import unittest
+
+from microsoft_graph_secapi.spill import SegmentLog
+
+
+def _record(key):
+    return {'externalId': key}
+
+
+class TestSegmentLog(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.log = SegmentLog(self.path, segment_size=3)
+        self.log.open()
+
+    def tearDown(self):
+        self.log.close()
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def _append(self, key, spilled=False):
+        return self.log.append(key, False, [_record(key)], 1.0, 'new', spilled=spilled)
+
+    def _reopen(self):
+        self.log.close()
+        self.log = SegmentLog(self.path, segment_size=3)
+        self.log.open()
+
+    def test_read_returns_only_spilled(self):
+        self._append('a')
+        self._append('b')
+        self._append('c', spilled=True)
+        self._append('d')
+        self._append('e', spilled=True)
+
+        entries = self.log.read(10)
+        self.assertEqual([e[1] for e in entries], ['c', 'e'])
+        self.assertEqual(entries[0][3], [_record('c')])
+        self.assertEqual(entries[0][5], 'new')
+        self.assertEqual(self.log.read(10), [])
+        self.assertEqual(len(self.log), 5)
+
+    def test_read_in_chunks_across_segments(self):
+        keys = ['k{}'.format(i) for i in range(8)]
+        for i, key in enumerate(keys):
+            self._append(key, spilled=i % 2 == 1)
+
+        result = []
+        while True:
+            entries = self.log.read(2)
+            if len(entries) == 0:
+                break
+            result.extend(e[1] for e in entries)
+
+        self.assertEqual(result, keys[1::2])
+
+    def test_spilled_after_partial_read(self):
+        self._append('a', spilled=True)
+        self.assertEqual([e[1] for e in self.log.read(10)], ['a'])
+
+        self._append('b')
+        self._append('c', spilled=True)
+        self.assertEqual([e[1] for e in self.log.read(10)], ['c'])
+
+    def test_acked_segments_are_removed(self):
+        seqs = [self._append(k) for k in ['a', 'b', 'c', 'd']]
+        for seq in seqs[:3]:
+            self.log.ack(seq)
+
+        self.assertEqual(len(self.log), 1)
+        self.assertEqual(len(self.log._segments), 1)
+
+    def test_reopen_reads_unacked(self):
+        seqs = [self._append(k) for k in ['a', 'b', 'c']]
+        self._append('d', spilled=True)
+        self.log.ack(seqs[0])
+        self.log.ack(seqs[2])
+
+        self._reopen()
+
+        self.assertEqual(len(self.log), 2)
+        self.assertEqual([k for _, k, _ in self.log.scan()], ['b', 'd'])
+        self.assertEqual([e[1] for e in self.log.read(10)], ['b', 'd'])
+
+        # new entries go after the replayed ones
+        self._append('e', spilled=True)
+        self.assertEqual([e[1] for e in self.log.read(10)], ['e'])
+
+    def test_reopen_ignores_truncated_line(self):
+        self._append('a', spilled=True)
+        self.log.close()
+        with open(self.log._segments[-1].path, 'ab') as f:
+            f.write('[1,"b",false,[')
+
+        self._reopen()
+
+        self.assertEqual([e[1] for e in self.log.read(10)], ['a'])
+
+
+if __name__ == '__main__':
+    unittest.main()